@@ -1,22 +1,33 @@
-import shutil
-from pathlib import Path
+import importlib
 
 try:
     from ._version import version as __version__
 except ImportError:
     __version__ = "unknown"
 
-from tseg._reader import napari_get_reader
-from tseg._widget import PreProcessingWidget, TrackingWidget
-from tseg._writer import write_multiple, write_single_image
-
 # from io import InputOutputWidget
 
-# Ensure the temporary folder exists and is empty
-temp_dir = Path.home() / ".tseg"
-if temp_dir.exists():
-    shutil.rmtree(temp_dir)
-temp_dir.mkdir()
+# The temporary folder (~/.tseg) is emptied by the first widget that is
+# opened (see config.session_temp_dir), not here: process-pool workers
+# re-import the package while the main process is writing to it.
+
+# napari finds the reader, writers and widgets through napari.yaml, so they
+# are only imported on first access: importing tseg.core (e.g. on a headless
+# node, or in every process-pool worker) does not load napari and Qt.
+_LAZY_ATTRIBUTES = {
+    "napari_get_reader": "tseg._reader",
+    "PreProcessingWidget": "tseg._widget",
+    "TrackingWidget": "tseg._widget",
+    "write_multiple": "tseg._writer",
+    "write_single_image": "tseg._writer",
+}
+
+
+def __getattr__(name):
+    if name in _LAZY_ATTRIBUTES:
+        return getattr(importlib.import_module(_LAZY_ATTRIBUTES[name]), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 
 __all__ = (
     "napari_get_reader",
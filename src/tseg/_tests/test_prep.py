@@ -0,0 +1,129 @@
+import numpy as np
+
+from tseg.widgets.prep import preprocess_image, lazy_preprocess_image, iter_planes, image_statistics, global_normalization, min_max_normalization, z_score_normalization, adaptive_thresh, adaptive_threshold, adaptive_threshold_plane, adaptive_threshold_sweep, Pipeline, OPERATIONS
+
+
+def _stack(shape, seed=0):
+    return np.random.default_rng(seed).integers(0, 4000, size=shape).astype(np.uint16)
+
+
+def test_preprocess_image_applies_operation_per_plane():
+    for shape in [(3, 24, 32), (5, 24, 32), (2, 3, 24, 32), (2, 3, 4, 24, 32)]:
+        image = _stack(shape)
+        planes = image.reshape(-1, *shape[-2:])
+        expected = np.stack([adaptive_thresh(plane, 9, 5) for plane in planes]).reshape(shape)
+        np.testing.assert_array_equal(preprocess_image(image, adaptive_thresh, sub_region=9, c_value=5), expected)
+        np.testing.assert_array_equal(preprocess_image(image, adaptive_thresh, workers=1, sub_region=9, c_value=5), expected)
+
+
+def test_preprocess_image_writes_into_out():
+    image = _stack((4, 24, 32))
+    out = np.zeros(image.shape, dtype=np.uint8)
+    result = preprocess_image(image, min_max_normalization, workers=2, out=out)
+    assert result is out
+    assert (out.reshape(4, -1).max(axis=1) == 255).all()
+
+
+def test_lazy_preprocess_image_matches_eager():
+    image = _stack((2, 3, 24, 32))
+    lazy = lazy_preprocess_image(image, adaptive_thresh, sub_region=9, c_value=5)
+    expected = preprocess_image(image, adaptive_thresh, sub_region=9, c_value=5)
+    assert lazy.dtype == expected.dtype and lazy.chunksize == (1, 1, 24, 32)
+    np.testing.assert_array_equal(lazy[1, 2].compute(), expected[1, 2])
+    np.testing.assert_array_equal(np.stack(list(iter_planes(lazy))), expected.reshape(-1, 24, 32))
+
+
+def test_iter_planes_computes_one_plane_at_a_time():
+    image = _stack((2, 2, 3, 24, 32))
+    computed = []
+    lazy = lazy_preprocess_image(image, lambda plane: computed.append(plane.shape) or plane)
+    computed.clear()  # the first plane is run once for the output dtype
+    planes = iter_planes(lazy)
+    np.testing.assert_array_equal(next(planes), image[0, 0, 0])
+    # a 5D result is not materialized a channel (4D) at a time
+    assert len(computed) == 1
+    np.testing.assert_array_equal(np.stack([image[0, 0, 0]] + list(planes)), image.reshape(-1, 24, 32))
+    assert len(computed) == 12
+
+
+def test_global_normalization_uses_stack_statistics():
+    image = _stack((2, 3, 24, 32))
+    statistics = image_statistics(image, histogram=True)[()]
+    assert statistics.count == image.size and statistics.min == image.min() and statistics.max == image.max()
+    np.testing.assert_allclose([statistics.mean, statistics.std], [image.mean(), image.std()])
+    assert statistics.percentile(50) == np.percentile(image, 50, method="inverted_cdf")
+
+    normalized = global_normalization(image, "minmax")
+    assert normalized.dtype == np.uint8 and normalized.min() == 0 and normalized.max() == 255
+    # one transform for the whole stack, unlike the per-slice min_max_normalization
+    np.testing.assert_array_equal(normalized, np.rint((image - statistics.min) * (255 / (statistics.max - statistics.min))).astype(np.uint8))
+
+    per_timepoint = image_statistics(image, "timepoint")
+    zscore = global_normalization(image, "zscore", "timepoint", statistics=per_timepoint)
+    for t in range(2):
+        stats = per_timepoint[(t,)]
+        expected = (image[t] - stats.mean) / stats.std
+        expected = (expected - expected.min()) * (255 / (expected.max() - expected.min()))
+        np.testing.assert_allclose(zscore[t], expected, atol=0.5 + 1e-3)
+
+
+def test_global_and_per_slice_zscore_have_the_same_output_type():
+    image = _stack((2, 3, 24, 32))
+    per_slice = preprocess_image(image, z_score_normalization)
+    for scope in ("global", "timepoint"):
+        for percentiles in (None, (1, 99)):
+            normalized = global_normalization(image, "zscore", scope, percentiles)
+            assert normalized.dtype == per_slice.dtype == np.uint8
+            assert (normalized.min(), normalized.max()) == (per_slice.min(), per_slice.max()) == (0, 255)
+
+
+def test_adaptive_threshold_matches_opencv_per_plane():
+    for dtype in (np.uint8, np.uint16, np.float32):
+        image = (np.random.default_rng(1).random((2, 3, 24, 32)) * 3000).astype(dtype)
+        expected = preprocess_image(image, adaptive_thresh, sub_region=9, c_value=5)
+        np.testing.assert_array_equal(adaptive_threshold(image, 9, 5), expected)
+
+
+def test_adaptive_threshold_volumetric_and_native():
+    image = _stack((6, 24, 32))
+    # a z neighbourhood of 1 through the summed-area path equals the per-plane result
+    z_stack = np.stack([image[0], image[0], image[0]])
+    np.testing.assert_array_equal(adaptive_threshold(z_stack, 9, 5, z_region=3)[1], adaptive_threshold(image[:1], 9, 5)[0])
+    native = adaptive_threshold(image, 5, 100, z_region=3, normalize=False)
+    padded = np.pad(image.astype(np.float64), ((1, 1), (2, 2), (2, 2)), mode="edge")
+    mean = np.mean([padded[dz : dz + 6, dy : dy + 24, dx : dx + 32] for dz in range(3) for dy in range(5) for dx in range(5)], axis=0)
+    np.testing.assert_array_equal(native, np.where(image <= mean - 100, 255, 0))
+
+
+def test_adaptive_threshold_plane_matches_volume():
+    image = _stack((5, 24, 32))
+    for z_region, normalize in [(1, True), (3, True), (3, False)]:
+        volume = adaptive_threshold(image, 9, 5, z_region=z_region, normalize=normalize)
+        for z in range(5):
+            np.testing.assert_array_equal(adaptive_threshold_plane(image, z, 9, 5, z_region=z_region, normalize=normalize), volume[z])
+
+
+def test_adaptive_threshold_sweep_matches_single_thresholds():
+    image = _stack((24, 32))
+    sub_regions, c_values = [3, 9, 15], [0, 5, 12]
+    gallery = adaptive_threshold_sweep(image, sub_regions, c_values)
+    assert gallery.shape == (3, 3, 24, 32)
+    for i, sub_region in enumerate(sub_regions):
+        for j, c_value in enumerate(c_values):
+            np.testing.assert_array_equal(gallery[i, j], adaptive_thresh(image, sub_region, c_value))
+    native = adaptive_threshold_sweep(_stack((3, 24, 32)), [5, 9], [50.0], z_region=3, normalize=False)
+    np.testing.assert_array_equal(native[1, 0], adaptive_threshold(_stack((3, 24, 32)), 9, 50.0, z_region=3, normalize=False))
+
+
+def test_pipeline_fuses_steps_and_round_trips(tmp_path):
+    image = _stack((3, 24, 32))
+    pipeline = Pipeline().add("min_max_normalization").add("apply_contrast_limit", min_val=np.float32(20), max_val=200).add("adaptive_threshold", sub_region=9, c_value=5)
+    expected = image
+    for name, params in pipeline.steps:
+        expected = preprocess_image(expected, OPERATIONS[name], **params)
+    np.testing.assert_array_equal(pipeline.run(image, workers=2), expected)
+
+    pipeline.save(tmp_path / "pipeline.json")
+    replayed = Pipeline.load(tmp_path / "pipeline.json")
+    assert replayed.steps == pipeline.steps
+    np.testing.assert_array_equal(replayed.run(image, lazy=True).compute(), expected)
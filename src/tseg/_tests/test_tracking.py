@@ -0,0 +1,350 @@
+import importlib
+import json
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+from tseg.core.parallel import Cancelled, _to_shared, task_context
+from tseg.core.tracking import ccl_3d, noise_removal, center_detection, object_statistics, stream_centers, Tracker, tracker, preprocessing_for_clustering, state_space, train, train_batch, martin, pairwise_martin, clustering, knn_affinity, cluster_sweep, computing_affinity, windowed_features, windowed_affinity, TrackTable
+
+
+def _blobs_movie():
+    # two frames with three and two cubic blobs of different volumes
+    movie = np.zeros((2, 8, 16, 16), dtype=np.uint8)
+    movie[0, 1:3, 1:3, 1:3] = 1
+    movie[0, 4:7, 8:11, 8:11] = 1
+    movie[0, 6, 14, 14] = 1
+    movie[1, 1:3, 2:4, 1:3] = 1
+    movie[1, 4:7, 9:12, 8:11] = 1
+    return movie
+
+
+def test_ccl_3d_compact_dtype(tmp_path):
+    movie = _blobs_movie()
+    labeled, ncomponents = ccl_3d(movie)
+    assert labeled.dtype == np.uint16
+    assert ncomponents.dtype.kind == "i"
+    np.testing.assert_array_equal(ncomponents, [3, 2])
+
+    mapped, _ = ccl_3d(movie, out=tmp_path / "labeled.npy")
+    assert isinstance(mapped, np.memmap)
+    np.testing.assert_array_equal(np.load(tmp_path / "labeled.npy"), labeled)
+
+
+def test_parallel_stages_match_serial():
+    movie = _blobs_movie()
+    labeled, _ = ccl_3d(movie)
+    threaded, _ = ccl_3d(movie, workers=2)
+    np.testing.assert_array_equal(threaded, labeled)
+
+    thr_idxs = noise_removal(movie, labeled, 1)
+    assert [list(i) for i in noise_removal(movie, labeled, 1, workers=2)] == [list(i) for i in thr_idxs]
+    serial = center_detection(movie, labeled, thr_idxs)
+    parallel = center_detection(movie, labeled, thr_idxs, workers=2)
+    for a, b in zip(serial, parallel):
+        np.testing.assert_allclose(a, b)
+
+
+def test_process_workers_map_memmapped_inputs(tmp_path):
+    movie = _blobs_movie()
+    labeled, _ = ccl_3d(movie, out=tmp_path / "labeled.npy")
+    image = np.lib.format.open_memmap(tmp_path / "movie.npy", mode="w+", dtype=movie.dtype, shape=movie.shape)
+    image[:] = movie
+    # the memory-mapped inputs are opened from their files, nothing goes to shared memory
+    assert _to_shared(labeled)[0] is None and _to_shared(np.asarray(labeled)[1:])[0] is None
+    thr_idxs = noise_removal(image, labeled, 1)
+    serial = center_detection(movie, np.asarray(labeled), thr_idxs)
+    for a, b in zip(serial, center_detection(image, labeled, thr_idxs, workers=2)):
+        np.testing.assert_allclose(a, b)
+
+
+def test_task_context_reports_progress_and_cancels():
+    movie = np.concatenate([_blobs_movie()] * 3)
+    reports = []
+    with task_context(lambda desc, done, total: reports.append((done, total))):
+        ccl_3d(movie, workers=2)
+    assert reports[0] == (0, 6) and reports[-1] == (6, 6)
+
+    # cancelled after the second frame, the remaining ones are never labeled
+    with pytest.raises(Cancelled), task_context(lambda desc, done, total: reports.append((done, total)), lambda: len(reports) > 2):
+        reports.clear()
+        ccl_3d(movie)
+    assert reports == [(0, 6), (1, 6), (2, 6)]
+    # outside of a task nothing is reported or cancelled
+    ccl_3d(movie)
+    assert len(reports) == 3
+
+
+def test_noise_removal_keeps_empty_frames_and_relabels():
+    movie = _blobs_movie()
+    movie = np.concatenate([movie[:1], np.zeros_like(movie[:1]), movie[1:]])
+    labeled, _ = ccl_3d(movie)
+
+    thr_idxs, cleaned = noise_removal(movie, labeled, 1, out=np.zeros_like(labeled))
+    assert [list(idxs) for idxs in thr_idxs] == [[1, 2], [], [1, 2]]
+    assert cleaned[0].max() == 2 and cleaned[0, 6, 14, 14] == 0
+    assert not cleaned[1].any()
+
+
+def test_object_statistics_matches_center_of_mass():
+    from scipy.ndimage import center_of_mass
+
+    movie = _blobs_movie()
+    intensity = movie * np.arange(movie[0].size, dtype=float).reshape(movie.shape[1:])
+    labeled, _ = ccl_3d(movie)
+
+    stats = object_statistics(intensity[0], labeled[0])
+    np.testing.assert_array_equal(stats.label, [1, 2, 3])
+    np.testing.assert_array_equal(stats.count, [8, 27, 1])
+    np.testing.assert_allclose(stats.centroid, center_of_mass(intensity[0], labeled[0], [1, 2, 3]))
+    np.testing.assert_array_equal(stats.bbox_min[1], [4, 8, 8])
+    np.testing.assert_array_equal(stats.bbox_max[1], [7, 11, 11])
+
+
+def test_stream_centers_matches_batch_stages():
+    movie = _blobs_movie()
+    labeled, _ = ccl_3d(movie)
+    thr_idxs = noise_removal(movie, labeled, 1)
+    batch = center_detection(movie, labeled, thr_idxs)
+
+    streamed, all_stats = stream_centers(movie, 1)
+    assert [len(stats) for stats in all_stats] == [2, 2]
+    for a, b in zip(batch, streamed):
+        np.testing.assert_allclose(a, b)
+
+
+def test_gated_tracker_links_nearby_centers():
+    frames = [
+        np.array([[0.0, 0.0, 0.0], [0.0, 50.0, 50.0]]),
+        np.array([[0.0, 52.0, 49.0], [1.0, 1.0, 1.0], [0.0, 200.0, 200.0]]),
+        np.zeros((0, 3)),
+    ]
+    dense = tracker(frames)
+    gated = tracker(frames, method="gated")
+    assert gated == dense
+    xx, yy, zz = gated
+    assert xx == [[0.0, 1.0], [50.0, 52.0], [200.0]]
+
+
+def test_tracker_finishes_tracks_after_gap():
+    frames = [np.array([[0.0, 0.0, 0.0]]), np.zeros((0, 3)), np.zeros((0, 3)), np.array([[0.0, 1.0, 1.0]]), np.zeros((0, 3))]
+    assert tracker(frames, method="gated")[0] == [[0.0, 1.0]]
+    assert tracker(frames, method="gated", max_gap=1)[0] == [[0.0], [1.0]]
+    assert tracker(frames, method="gated", max_gap=2)[0] == [[0.0, 1.0]]
+
+
+def test_track_table_columns_and_complete_tracks():
+    frames = [
+        np.array([[0.0, 0.0, 0.0], [5.0, 50.0, 50.0]]),
+        np.array([[5.0, 52.0, 49.0], [1.0, 1.0, 1.0]]),
+        np.array([[9.0, 90.0, 90.0], [1.0, 2.0, 2.0]]),
+        np.zeros((0, 3)),
+    ]
+    table = tracker(frames, method="gated", as_table=True)
+    assert len(table) == 3
+    np.testing.assert_array_equal(table.offsets, [0, 3, 5, 6])
+    np.testing.assert_array_equal(table.napari_tracks()[:3], [[0, 0, 0, 0, 0], [0, 1, 1, 1, 1], [0, 2, 1, 2, 2]])
+    assert table.to_lists() == tracker(frames, method="gated")
+
+    xx, yy, zz = preprocessing_for_clustering(table, frame_number=3)
+    np.testing.assert_array_equal(xx, [[0.0, 1.0, 2.0]])
+    np.testing.assert_array_equal(zz, [[0.0, 1.0, 1.0]])
+
+
+def test_online_tracker_matches_batch_tracker():
+    rng = np.random.default_rng(0)
+    positions = rng.random((40, 3)) * [10, 200, 200]
+    frames = []
+    for _ in range(8):
+        positions = positions + rng.normal(0, 1, positions.shape)
+        frames.append(positions[rng.random(len(positions)) > 0.1])
+
+    online = Tracker(method="gated", max_gap=1)
+    for frame_index, centers in enumerate(frames):
+        track_ids = online.update(frame_index, centers)
+        assert len(set(track_ids)) == len(centers)
+    batch = tracker(frames, method="gated", max_gap=1, as_table=True)
+    np.testing.assert_array_equal(online.finalize().napari_tracks(), batch.napari_tracks())
+    # every frame is tracked, the last one included
+    assert batch.napari_tracks()[:, 1].max() == len(frames) - 1
+
+
+def _ar_systems(n=6, frames=12, order=2):
+    rng = np.random.default_rng(1)
+    traj_pool = np.cumsum(rng.normal(size=(3, n, frames)), axis=2)
+    X, C = state_space(traj_pool.reshape(3, -1), 2)
+    flatten_AR_mat = np.array([np.concatenate([A.flatten() for A in train(X[:, frames * i : frames * (i + 1)], order)]) for i in range(n)])
+    return flatten_AR_mat, C
+
+
+def test_pairwise_martin_matches_symmetrized_loop():
+    flatten_AR_mat, C = _ar_systems()
+    n = len(flatten_AR_mat)
+    expected = np.array([[martin(flatten_AR_mat[i], C, flatten_AR_mat[j], C) for j in range(n)] for i in range(n)])
+    expected = (expected + expected.T) * 0.5
+    np.fill_diagonal(expected, 0.0)
+
+    np.testing.assert_allclose(pairwise_martin(flatten_AR_mat, C, block_size=4, method="lyapunov"), expected, rtol=1e-6, atol=1e-8)
+    np.testing.assert_allclose(pairwise_martin(flatten_AR_mat, C, block_size=4), expected, rtol=1e-5, atol=1e-6)
+    np.testing.assert_allclose(pairwise_martin(flatten_AR_mat, C, workers=2, block_size=4), expected, rtol=1e-6, atol=1e-8)
+
+
+def test_train_batch_matches_train():
+    rng = np.random.default_rng(2)
+    frames, n, order = 15, 7, 3
+    X, _ = state_space(np.cumsum(rng.normal(size=(3, n * frames)), axis=1), 2)
+    expected = [np.concatenate([A.flatten() for A in train(X[:, frames * i : frames * (i + 1)], order)]) for i in range(n)]
+    np.testing.assert_allclose(train_batch(X, frames, order), expected)
+
+
+def test_knn_affinity_keeps_neighbour_pairs_of_dense_similarity():
+    flatten_AR_mat, C = _ar_systems(n=8)
+    distances = pairwise_martin(flatten_AR_mat, C)
+    similarity = knn_affinity(flatten_AR_mat, C, n_neighbors=7)
+    # with every pair kept the sparse affinity equals the dense one
+    off_diagonal = distances[np.triu_indices(8, 1)]
+    expected = np.exp(-0.5 * distances / off_diagonal.std())
+    np.fill_diagonal(expected, 1)
+    np.testing.assert_allclose(similarity.toarray(), expected, rtol=1e-5)
+    sparse = knn_affinity(flatten_AR_mat, C, n_neighbors=2)
+    assert (sparse != sparse.T).nnz == 0
+    assert sparse.nnz < 64
+
+
+def test_cluster_sweep_finds_block_structure():
+    rng = np.random.default_rng(2)
+    truth = np.repeat([0, 1, 2], [12, 9, 9])
+    affinity = np.where(truth[:, None] == truth[None, :], 0.9, 0.05) + 0.02 * rng.random((30, 30))
+    affinity = (affinity + affinity.T) / 2
+    embedding, results = cluster_sweep(affinity, range(1, 6))
+    assert embedding.max_clusters == 5
+    assert np.argmax(embedding.eigengaps) + 1 == 3
+    labels, _, silhouette = results[3]
+    assert len(np.unique(labels)) == 3
+    assert all(len(np.unique(labels[truth == c])) == 1 for c in range(3))
+    assert silhouette == max(score for _, _, score in results.values() if not np.isnan(score))
+    # both label assignments recover the blocks, discretize as SpectralClustering does
+    kmeans = embedding.labels(3, "kmeans")
+    assert len(set(zip(truth, kmeans))) == 3 and len(set(zip(truth, labels))) == 3
+    # a sampled silhouette estimates the full one
+    assert abs(embedding.silhouette(3, sample_size=20) - embedding.silhouette(3, sample_size=None)) < 0.1
+
+
+def test_pairwise_martin_resumes_from_checkpoint(tmp_path):
+    flatten_AR_mat, C = _ar_systems(n=9)
+    expected = pairwise_martin(flatten_AR_mat, C)
+    out = tmp_path / "martin_distances.npy"
+    manifest = tmp_path / "martin_distances.npy.manifest.json"
+    np.testing.assert_allclose(pairwise_martin(flatten_AR_mat, C, block_size=4, out=out), expected, rtol=1e-12)
+    record = json.loads(manifest.read_text())
+    assert len(record["completed"]) == 6
+
+    # pretend the run stopped after the first block: only the others are recomputed
+    record["completed"] = [[0, 0]]
+    manifest.write_text(json.dumps(record))
+    distances = np.load(out, mmap_mode="r+")
+    distances[:] = -1
+    distances.flush()
+    reports = []
+    with task_context(lambda desc, done, total: reports.append((desc, done, total))):
+        resumed = pairwise_martin(flatten_AR_mat, C, block_size=4, out=out)
+    # the resumed blocks are reported as progress, not printed, and it only goes up
+    martin = [(done, total) for desc, done, total in reports if desc == "Martin distances"]
+    assert martin[0] == (1, 6) and martin == sorted(martin) and martin[-1] == (6, 6)
+    assert isinstance(resumed, np.memmap)
+    assert (resumed[:4, :4] == -1).all()
+    resumed[:4, :4] = expected[:4, :4]
+    np.testing.assert_allclose(resumed, expected, rtol=1e-12)
+
+
+def test_checkpoint_resumes_after_reimporting_the_plugin(tmp_path, monkeypatch):
+    import tseg
+
+    # the widget's default output locations, inside a temporary home directory
+    monkeypatch.setenv("HOME", str(tmp_path))
+    monkeypatch.setenv("USERPROFILE", str(tmp_path))
+    flatten_AR_mat, C = _ar_systems(n=9)
+    out = tmp_path / "tseg_output" / "centers_affinity" / "martin_distances.npy"
+    expected = pairwise_martin(flatten_AR_mat, C, block_size=4, out=out)
+
+    # loading the plugin again (e.g. a new napari session) keeps the checkpoint
+    importlib.reload(tseg)
+    manifest = json.loads((tmp_path / "tseg_output" / "centers_affinity" / "martin_distances.npy.manifest.json").read_text())
+    assert len(manifest["completed"]) == 6
+    np.testing.assert_array_equal(pairwise_martin(flatten_AR_mat, C, block_size=4, out=out), expected)
+
+
+def test_clustering_does_not_depend_on_affinity_storage(tmp_path):
+    rng = np.random.default_rng(4)
+    groups = np.repeat([0, 1, 2], 5)
+    similarity = np.where(groups[:, None] == groups[None, :], 0.9, 0.05) + rng.uniform(0, 0.05, (15, 15))
+    similarity = (similarity + similarity.T) / 2
+    mapped = np.lib.format.open_memmap(tmp_path / "similarity.npy", mode="w+", dtype=np.float64, shape=similarity.shape)
+    mapped[:] = similarity
+
+    # the same partition (label numbers aside) whether or not the affinity is memory-mapped
+    labels = clustering(similarity, 3, tmp_path / "labels.npy", tmp_path / "affinity.npy")
+    mapped_labels = clustering(mapped, 3, tmp_path / "mapped_labels.npy", tmp_path / "mapped_affinity.npy")
+    assert len(set(zip(groups, labels))) == 3 and len(set(zip(labels, mapped_labels))) == 3
+    np.testing.assert_array_equal(np.load(tmp_path / "mapped_affinity.npy"), similarity)
+    streamed = clustering(mapped, 3, tmp_path / "streamed_labels.npy", tmp_path / "streamed_affinity.npy", streamed=True)
+    assert len(set(zip(labels, streamed))) == 3
+
+
+def test_tracking_core_imports_without_the_gui_stack():
+    # a fresh interpreter, the test session may have imported them already
+    code = "import sys, tseg.core.tracking; print([m for m in ('napari', 'matplotlib.pyplot', 'qtpy') if m in sys.modules])"
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True, env={**os.environ, "PYTHONPATH": os.pathsep.join(sys.path)})
+    assert result.stdout.strip() == "[]"
+
+
+def test_computing_affinity_is_headless():
+    rng = np.random.default_rng(3)
+    traj_pool = np.cumsum(rng.normal(size=(3, 7, 10)), axis=2)
+    flatten_AR_mat = np.zeros((7, 2 * 4))
+    similarity1, similarity2, _, (X, C) = computing_affinity(traj_pool, 10, flatten_AR_mat, 7, 2)
+    distances = pairwise_martin(flatten_AR_mat, C)
+    np.testing.assert_allclose(similarity1, np.exp(-0.5 * distances / distances.std()), rtol=1e-12)
+    assert similarity2.shape == (7, 7)
+
+
+def test_windowed_features_use_partial_tracks():
+    rng = np.random.default_rng(4)
+    tracks = [[(t0 + i, point) for i, point in enumerate(np.cumsum(rng.normal(size=(length, 3)), axis=0))] for t0, length in [(0, 30), (5, 12), (2, 7), (0, 30)]]
+    table = TrackTable.from_tracks(tracks)
+    track_index, xx, yy, zz = table.windows(10, 5)
+    # 5 windows for each 30-point track, 1 for the 12-point one, none for the shortest
+    assert track_index.tolist() == [0] * 5 + [1] + [3] * 5
+    np.testing.assert_array_equal(xx[5], table.y[30:40])
+    window_AR_mat, window_rows, C = windowed_features(table, 10, 5)
+    assert window_rows.tolist() == track_index.tolist() and window_AR_mat.shape == (11, 8)
+
+    # track affinities are the mean window-pair affinities
+    window_similarity, _, _, _ = windowed_affinity(table, 10, 5, aggregate="window")
+    similarity, rows, _, _ = windowed_affinity(table, 10, 5)
+    assert rows.tolist() == [0, 1, 3] and similarity.shape == (3, 3)
+    np.testing.assert_allclose(similarity[0, 2], window_similarity[:5, 6:].mean())
+    np.testing.assert_allclose(similarity[1, 1], window_similarity[5, 5])
+    sparse_similarity, _, _, _ = windowed_affinity(table, 10, 5, n_neighbors=3)
+    assert sparse_similarity.shape == (3, 3)
+
+    # a window longer than every track (e.g. on a short movie) is reported, not crashed on
+    with pytest.raises(ValueError, match="No track has 31 consecutive frames"):
+        windowed_features(table, 31)
+    with pytest.raises(ValueError, match="too short"):
+        windowed_features(table, 2, ar_order=2)
+
+
+def test_windows_do_not_span_frame_gaps():
+    points = np.arange(36, dtype=float)[:, None] * [1.0, 2.0, 3.0]
+    # frames 0..11, a gap, then frames 14..37
+    table = TrackTable.from_tracks([[(t, point) for t, point in zip(list(range(12)) + list(range(14, 38)), points)]])
+    _, starts, ends = table.runs()
+    assert starts.tolist() == [0, 12] and ends.tolist() == [12, 36]
+    track_index, xx, yy, zz = table.windows(10, 5)
+    # one window before the gap, three after it, none across it
+    assert track_index.tolist() == [0] * 4
+    np.testing.assert_array_equal(xx[:, 0], table.y[[0, 12, 17, 22]])
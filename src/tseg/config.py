@@ -1,4 +1,6 @@
 import os
+import shutil
+from pathlib import Path
 
 # Dictionary to hold shared configuration settings
 shared_config = {}
@@ -9,6 +11,25 @@ output_dir = os.path.join(os.path.expanduser("~"), "tseg_output")
 # Store the output directory path in the shared configuration dictionary
 shared_config["output_dir"] = output_dir
 
+# Scratch folder for intermediate results (labels, saved layers, ...)
+temp_dir = Path.home() / ".tseg"
+_temp_dir_cleared = False
+
+
+def session_temp_dir():
+    """
+    Returns ``temp_dir``, emptied the first time a widget asks for it in a
+    session. Importing the package does not touch it, so process-pool
+    workers (which re-import it) and headless use of ``tseg.core`` never
+    delete files that are still in use.
+    """
+    global _temp_dir_cleared
+    if not _temp_dir_cleared:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        _temp_dir_cleared = True
+    temp_dir.mkdir(parents=True, exist_ok=True)
+    return temp_dir
+
 
 class TsegStyles:
     """
@@ -0,0 +1,234 @@
+import mmap
+import os
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from multiprocessing import shared_memory
+
+import numpy as np
+from tqdm import tqdm
+
+# Arrays attached to shared memory inside a process-pool worker.
+_shared_arrays = ()
+_shared_blocks = []
+# threadpoolctl limit of a process-pool worker, lifted when it is collected.
+_blas_limiter = None
+
+# (progress, is_cancelled) hooks of the task running in this thread, see task_context.
+_task = threading.local()
+
+
+class Cancelled(Exception):
+    """Raised between frames or blocks once the running task has been cancelled."""
+
+
+@contextmanager
+def task_context(progress=None, is_cancelled=None):
+    """
+    Runs the enclosed block as a cancellable task: ``map_frames`` and
+    ``progress_iter`` calls made from this thread report
+    ``progress(desc, done, total)`` after every frame or block and raise
+    ``Cancelled`` at the next one once ``is_cancelled()`` returns True.
+    """
+    previous = getattr(_task, "hooks", None)
+    _task.hooks = (progress, is_cancelled)
+    try:
+        yield
+    finally:
+        _task.hooks = previous
+
+
+def checkpoint(desc=None, done=None, total=None):
+    """
+    Reports progress to the task running in this thread and raises
+    ``Cancelled`` if it has been cancelled. Does nothing outside of
+    ``task_context``.
+    """
+    hooks = getattr(_task, "hooks", None)
+    if hooks is None:
+        return
+    progress, is_cancelled = hooks
+    if is_cancelled is not None and is_cancelled():
+        raise Cancelled(desc or "task")
+    if progress is not None and total is not None:
+        progress(desc, done, total)
+
+
+def progress_iter(iterable, desc=None, total=None):
+    """``tqdm(iterable)`` that also reports to, and can be cancelled by, the running task."""
+    if total is None and hasattr(iterable, "__len__"):
+        total = len(iterable)
+    checkpoint(desc, 0, total)
+    for done, item in enumerate(tqdm(iterable, desc=desc, total=total), 1):
+        yield item
+        checkpoint(desc, done, total)
+
+
+def resolve_workers(workers):
+    """
+    Turns a ``workers`` argument into a worker count: ``None`` or a value
+    below 1 means "use every core".
+    """
+    if workers is None or workers < 1:
+        return os.cpu_count() or 1
+    return int(workers)
+
+
+def _file_spec(arr):
+    """
+    ``(filename, offset)`` of a C-contiguous array lying in a memory-mapped
+    file (a ``np.memmap``, or a view of one), ``None`` otherwise.
+    """
+    base = arr
+    while isinstance(base, np.ndarray) and not isinstance(base, np.memmap):
+        base = base.base
+    if not isinstance(base, np.memmap) or not isinstance(base.base, mmap.mmap) or base.filename is None:
+        return None
+    if arr.size == 0 or not arr.flags.c_contiguous:
+        return None
+    start = arr.__array_interface__["data"][0] - base.__array_interface__["data"][0]
+    return base.filename, base.offset + start
+
+
+def _to_shared(arr):
+    spec = _file_spec(arr) if isinstance(arr, np.ndarray) else None
+    if spec is not None:
+        # already on disk: workers map the same file instead of a copy in RAM
+        return None, ("file",) + spec + (arr.shape, arr.dtype.str)
+    arr = np.asarray(arr)
+    block = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+    view = np.ndarray(arr.shape, dtype=arr.dtype, buffer=block.buf)
+    # copy frame by frame so that lazily computed inputs are streamed, not loaded
+    for i in range(arr.shape[0]):
+        view[i] = arr[i]
+    return block, ("shm", block.name, arr.shape, arr.dtype.str)
+
+
+def _limit_blas_threads(blas_threads):
+    global _blas_limiter
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return
+    _blas_limiter = threadpool_limits(limits=blas_threads)
+
+
+def _attach_shared(specs, blas_threads=None):
+    global _shared_arrays
+    if blas_threads is not None:
+        _limit_blas_threads(blas_threads)
+    arrays = []
+    for kind, *spec in specs:
+        if kind == "file":
+            filename, offset, shape, dtype = spec
+            arrays.append(np.memmap(filename, dtype=dtype, mode="r", offset=offset, shape=shape))
+            continue
+        name, shape, dtype = spec
+        block = shared_memory.SharedMemory(name=name)
+        _shared_blocks.append(block)
+        arrays.append(np.ndarray(shape, dtype=dtype, buffer=block.buf))
+    _shared_arrays = tuple(arrays)
+
+
+def _call_shared(func, frame, *frame_args):
+    return func(frame, *_shared_arrays, *frame_args)
+
+
+def _collect(futures, done):
+    try:
+        for future in as_completed(futures):
+            done(futures[future], future.result())
+    except BaseException:
+        # a cancelled task (or a failing frame) does not wait for the queued frames
+        for future in futures:
+            future.cancel()
+        raise
+
+
+def map_frames(func, arrays, n_frames, workers=1, backend="thread", desc=None, frame_args=None, blas_threads=None, callback=None, initial=0):
+    """
+    Calls ``func(frame, *arrays)`` for every frame index and returns the
+    results in frame order.
+
+    Parameters
+    ----------
+    func : callable
+        Per-frame function. For the process backend it has to be picklable,
+        i.e. a module level function (or a ``functools.partial`` of one).
+    arrays : sequence of arrays
+        Arrays indexed by ``func``. The process backend copies them once
+        into shared memory instead of pickling them for every task; arrays
+        already memory-mapped from a file are opened read-only from that
+        file by every worker instead.
+    n_frames : integer
+        Number of frames.
+    workers : integer, optional
+        Number of workers. 1 runs serially, ``None`` uses every core.
+    backend : {"thread", "process"}
+        Threads suit calls that release the GIL (most of scipy.ndimage),
+        processes suit the rest.
+    desc : str, optional
+        Progress bar description.
+    frame_args : sequence, optional
+        Extra per-frame argument; ``frame_args[frame]`` is passed to ``func``
+        after the arrays, so only that frame's share is sent to a worker.
+    blas_threads : integer, optional
+        Caps the BLAS/OpenMP threads of every worker process (needs
+        ``threadpoolctl``) so that linear-algebra heavy tasks do not
+        oversubscribe the cores.
+    callback : callable, optional
+        Called in the calling thread as ``callback(frame, result)`` as soon
+        as a frame is done, in completion order. Its return value is stored
+        instead of the result, so returning ``None`` lets large results be
+        consumed (e.g. written to disk) without keeping them in memory.
+    initial : integer, optional
+        Number of frames done before this call (e.g. restored from a
+        checkpoint). Progress is reported as ``initial`` plus the frames
+        done out of ``initial + n_frames``.
+
+    Inside ``task_context`` every finished frame is reported as progress
+    and a cancelled task stops before the frames still queued.
+
+    Returns
+    -------
+    results : list
+        ``func``'s return values (or ``callback``'s), indexed by frame.
+    """
+    workers = min(resolve_workers(workers), max(n_frames, 1))
+    extra = (lambda frame: ()) if frame_args is None else (lambda frame: (frame_args[frame],))
+    results = [None] * n_frames
+    progress = tqdm(total=initial + n_frames, initial=initial, desc=desc)
+    checkpoint(desc, initial, progress.total)
+
+    def done(frame, result):
+        results[frame] = result if callback is None else callback(frame, result)
+        progress.update()
+        checkpoint(desc, progress.n, progress.total)
+
+    try:
+        if workers == 1:
+            for frame in range(n_frames):
+                done(frame, func(frame, *arrays, *extra(frame)))
+        elif backend == "thread":
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                _collect({executor.submit(func, frame, *arrays, *extra(frame)): frame for frame in range(n_frames)}, done)
+        elif backend == "process":
+            blocks, specs = [], []
+            try:
+                for arr in arrays:
+                    block, spec = _to_shared(arr)
+                    if block is not None:
+                        blocks.append(block)
+                    specs.append(spec)
+                with ProcessPoolExecutor(max_workers=workers, initializer=_attach_shared, initargs=(specs, blas_threads)) as executor:
+                    _collect({executor.submit(_call_shared, func, frame, *extra(frame)): frame for frame in range(n_frames)}, done)
+            finally:
+                for block in blocks:
+                    block.close()
+                    block.unlink()
+        else:
+            raise ValueError(f'Unknown backend "{backend}", expected "thread" or "process".')
+    finally:
+        # cancelled or failing tasks do not leave a dangling bar behind
+        progress.close()
+    return results
@@ -1,118 +1,666 @@
+import hashlib
+import json
+import os
+from functools import partial
+from pathlib import Path
+
 import numpy as np
-from scipy.ndimage import center_of_mass
-from tqdm import tqdm
 from scipy.spatial import distance
 from scipy.optimize import linear_sum_assignment
-from matplotlib import pyplot as plt
 import scipy.linalg as sla
 
+from tseg.core.parallel import map_frames, progress_iter
+
+
+def label_dtype(max_label):
+    """
+    Returns the smallest unsigned integer dtype (uint16 or wider) that can
+    hold label values up to ``max_label``.
+    """
+    for dtype in (np.uint16, np.uint32):
+        if max_label <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype(np.uint64)
+
+
+def _max_components(all_image_arr):
+    """
+    Upper bound on the number of components a single frame can hold with a
+    full (3x3x3) connectivity structure: components have to be separated by
+    at least one background voxel along every axis, and there can never be
+    more components than foreground voxels.
+    """
+    spatial_bound = int(np.prod([(s + 1) // 2 for s in all_image_arr.shape[1:]]))
+    foreground = max((int(np.count_nonzero(frame)) for frame in all_image_arr), default=0)
+    return min(spatial_bound, foreground)
+
+
+def _output_buffer(out, shape, dtype):
+    """
+    Resolves an ``out`` argument: ``None`` allocates a zeroed array, a path
+    creates a memory-mapped ``.npy`` file and an array is used as is.
+    """
+    if out is None:
+        return np.zeros(shape=shape, dtype=dtype)
+    if not hasattr(out, "shape"):
+        return np.lib.format.open_memmap(out, mode="w+", dtype=dtype, shape=shape)
+    if out.shape != shape:
+        raise ValueError(f"Output buffer has shape {out.shape}, expected {shape}")
+    return out
+
+
+def _label_frame(frame, all_image_arr, all_labeled, structure):
+    from scipy.ndimage import label
+
+    # scipy can label straight into ndarray views; anything else (e.g. zarr
+    # or h5py datasets) goes through a single-frame scratch buffer.
+    if isinstance(all_labeled, np.ndarray):
+        return label(all_image_arr[frame], structure, output=all_labeled[frame])
+    labeled = np.empty(all_image_arr.shape[1:], dtype=all_labeled.dtype)
+    ncomponents = label(all_image_arr[frame], structure, output=labeled)
+    all_labeled[frame] = labeled
+    return ncomponents
 
-def ccl_3d(all_image_arr):
+
+def ccl_3d(all_image_arr, out=None, dtype=None, workers=1):
     """
     First we extract the labels of the components for all the cells
     across all the frames. Thus the number of components and their labels
     are discovered here:
-    """
-    from scipy.ndimage import label
 
+    Parameters
+    ----------
+    all_image_arr : array, shape (T, Z, Y, X)
+        Binary (or thresholded) movie.
+    out : array or path, optional
+        Output buffer for the labels. Either an array of the movie's shape
+        (e.g. a ``np.memmap``) or a path to a ``.npy`` file that is created
+        as a memory-mapped array, so the labeled movie never has to fit in
+        RAM.
+    dtype : dtype, optional
+        Label dtype. By default the smallest integer dtype that can hold
+        the largest possible label count is used (see ``label_dtype``).
+    workers : integer, optional
+        Number of threads labeling frames concurrently (``scipy.ndimage.label``
+        releases the GIL). ``None`` uses every core.
+    Returns
+    -------
+    all_labeled : array, shape (T, Z, Y, X)
+        Labeled movie (``out`` if it was an array).
+    all_ncomponents : array of int, shape (T,)
+        Number of components found in every frame.
+    """
     all_image_arr = np.asarray(all_image_arr)
     structure = np.ones((3, 3, 3), dtype=int)
-    all_labeled = np.zeros(shape=all_image_arr.shape)
-    all_ncomponents = np.zeros(all_image_arr.shape[0])
 
-    for frames in tqdm(range(all_image_arr.shape[0]), desc="3D Connected Component Calculation"):
-        all_labeled[frames], all_ncomponents[frames] = label(all_image_arr[frames], structure)
+    if dtype is None and not hasattr(out, "shape"):
+        dtype = label_dtype(_max_components(all_image_arr))
+    all_labeled = _output_buffer(out, all_image_arr.shape, dtype)
+
+    all_ncomponents = map_frames(
+        partial(_label_frame, structure=structure),
+        (all_image_arr, all_labeled),
+        all_image_arr.shape[0],
+        workers=workers,
+        backend="thread",
+        desc="3D Connected Component Calculation",
+    )
+    all_ncomponents = np.asarray(all_ncomponents, dtype=np.intp)
+
+    if isinstance(all_labeled, np.memmap):
+        all_labeled.flush()
 
     return all_labeled, all_ncomponents
 
 
-def noise_removal(all_img_arr, all_labeled, vol_threshold=1):
+def _kept_labels(frame, all_labeled, vol_threshold, cleaned=None):
+    labeled = np.asarray(all_labeled[frame])
+    if labeled.dtype.kind not in "ui":
+        labeled = labeled.astype(np.intp)
+    counts = np.bincount(labeled.ravel())
+    counts[0] = 0  # background
+    kept = np.flatnonzero(counts > vol_threshold)
+
+    if cleaned is not None:
+        lut = np.zeros(len(counts), dtype=cleaned.dtype)
+        lut[kept] = np.arange(1, len(kept) + 1)
+        cleaned[frame] = lut[labeled]
+    return kept
+
+
+def noise_removal(all_img_arr, all_labeled, vol_threshold=1, workers=1, out=None):
     """
     For Removing the noise,, i've considered only the components with
     the volume greater tha 1 pixel. Thus first I computed the volume of
     each component and then extracted the centers only for the components
-    with the volume greater than 1 pixels:
+    with the volume greater than 1 pixels.
+
+    Parameters
+    ----------
+    all_img_arr : array, shape (T, Z, Y, X)
+        Original movie.
+    all_labeled : array, shape (T, Z, Y, X)
+        Labeled movie, as returned by ``ccl_3d``.
+    vol_threshold : integer
+        Components with at most this many voxels are removed.
+    workers : integer, optional
+        Number of parallel workers, ``None`` uses every core.
+    out : array or path, optional
+        If given, a cleaned label volume is written here in the same pass:
+        removed components become background and the kept ones are
+        relabeled 1..n in every frame. A path creates a memory-mapped
+        ``.npy`` file.
+    Returns
+    -------
+    thr_idxs : list of integer arrays
+        Labels of the kept components, one array per frame (empty for
+        frames without any kept component).
+    cleaned : array
+        The cleaned label volume; only returned when ``out`` is given.
     """
     all_img_arr = np.asarray(all_img_arr)
+    all_labeled = np.asarray(all_labeled)
+
+    if out is None:
+        # a bincount per frame is cheap, threads avoid copying the movie to the workers
+        return map_frames(
+            partial(_kept_labels, vol_threshold=vol_threshold),
+            (all_labeled,),
+            all_img_arr.shape[0],
+            workers=workers,
+            backend="thread",
+            desc=f"Selecting volumes > {vol_threshold}",
+        )
 
-    unique = list()
-    counts = list()
-    for frames in range(all_img_arr.shape[0]):
-        unq = np.unique(all_labeled[frames], return_counts=True)
-        unique.append(unq[0])
-        counts.append(unq[1])
+    dtype = all_labeled.dtype if all_labeled.dtype.kind in "ui" else np.dtype(np.uint32)
+    cleaned = _output_buffer(out, all_labeled.shape, dtype)
+    # The relabeled frames are written straight into the output buffer, so
+    # this runs on threads that share it.
+    thr_idxs = map_frames(
+        partial(_kept_labels, vol_threshold=vol_threshold, cleaned=cleaned),
+        (all_labeled,),
+        all_img_arr.shape[0],
+        workers=workers,
+        backend="thread",
+        desc=f"Selecting volumes > {vol_threshold}",
+    )
+    if isinstance(cleaned, np.memmap):
+        cleaned.flush()
+    return thr_idxs, cleaned
+
+
+def _statistics_dtype(ndim):
+    return np.dtype(
+        [
+            ("label", np.intp),
+            ("count", np.intp),
+            ("centroid", np.float64, (ndim,)),
+            ("bbox_min", np.intp, (ndim,)),
+            ("bbox_max", np.intp, (ndim,)),
+            ("mean_intensity", np.float64),
+        ]
+    )
 
-    # Here I'm selecting only the center of the components with the volume
-    # less than 1 pixel and put them in thr_idxs list  :
 
-    thr_idxs = [[]]
-    for i in tqdm(range(len(counts)), desc=f"Selecting volumes > {vol_threshold}"):
-        for j in range(1, len(counts[i])):
-            if counts[i][j] > vol_threshold:
-                thr_idxs[i].append(unique[i][j])
-        thr_idxs.append([])
-    thr_idxs = [pick for pick in thr_idxs if len(pick) > 0]
+def object_statistics(image, labeled, index=None):
+    """
+    Computes the statistics of every labeled component of a single frame.
+    Voxel counts, intensity sums and intensity weighted coordinate sums are
+    all accumulated with ``np.bincount`` over the foreground voxels, so the
+    frame is scanned once instead of once per statistic.
+    Parameters
+    ----------
+    image : array
+        Intensity image used as weights for the centroids.
+    labeled : array
+        Labels of ``image``'s components; 0 is background.
+    index : sequence of integers, optional
+        Labels to report, in this order. By default every label present in
+        the frame is reported in increasing order.
+    Returns
+    -------
+    stats : record array
+        One record per label with the fields ``label``, ``count``,
+        ``centroid`` (intensity weighted, same as
+        ``scipy.ndimage.center_of_mass``), ``bbox_min``, ``bbox_max``
+        (exclusive) and ``mean_intensity``.
+    """
+    from scipy.ndimage import find_objects
+
+    image = np.asarray(image)
+    labeled = np.asarray(labeled)
+    ndim = labeled.ndim
+
+    foreground = np.flatnonzero(labeled)
+    labels = labeled.ravel()[foreground].astype(np.intp)
+    weights = image.ravel()[foreground].astype(np.float64)
+    n_labels = int(labels.max()) + 1 if len(labels) else 1
+    if index is not None:
+        index = np.asarray(index, dtype=np.intp)
+        n_labels = max(n_labels, int(index.max()) + 1 if len(index) else 1)
+
+    counts = np.bincount(labels, minlength=n_labels)
+    mass = np.bincount(labels, weights=weights, minlength=n_labels)
+    coord_sums = np.empty((n_labels, ndim))
+    for axis, coords in enumerate(np.unravel_index(foreground, labeled.shape)):
+        coord_sums[:, axis] = np.bincount(labels, weights=weights * coords, minlength=n_labels)
+
+    if index is None:
+        index = np.flatnonzero(counts)
+        index = index[index > 0]
+
+    stats = np.zeros(len(index), dtype=_statistics_dtype(ndim)).view(np.recarray)
+    stats.label = index
+    stats.count = counts[index]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        stats.centroid = coord_sums[index] / mass[index, None]
+        stats.mean_intensity = mass[index] / counts[index]
+
+    # find_objects walks the label image once in C; empty labels keep a
+    # zero-sized box.
+    boxes = find_objects(labeled.astype(np.intp, copy=False), max_label=n_labels - 1)
+    for row, lbl in enumerate(index):
+        box = boxes[lbl - 1] if lbl > 0 else None
+        if box is not None:
+            stats.bbox_min[row] = [sl.start for sl in box]
+            stats.bbox_max[row] = [sl.stop for sl in box]
+    return stats
+
+
+def _frame_statistics(frame, all_img_arr, all_labeled, idxs=None):
+    return object_statistics(all_img_arr[frame], all_labeled[frame], index=idxs)
+
+
+def frame_statistics(all_img_arr, all_labeled, thr_idxs=None, workers=1):
+    """
+    Runs ``object_statistics`` on every frame of a movie.
+    Parameters
+    ----------
+    all_img_arr, all_labeled : array, shape (T, Z, Y, X)
+        Original and labeled movies.
+    thr_idxs : list of integer arrays, optional
+        Labels to report per frame (e.g. the output of ``noise_removal``).
+        By default all components are reported.
+    workers : integer, optional
+        Number of parallel processes, ``None`` uses every core.
+    Returns
+    -------
+    all_stats : list of record arrays
+        One statistics table per frame.
+    """
+    all_img_arr = np.asarray(all_img_arr)
 
-    return thr_idxs
+    return map_frames(
+        _frame_statistics,
+        (all_img_arr, all_labeled),
+        all_img_arr.shape[0],
+        workers=workers,
+        backend="process",
+        desc="Measuring components",
+        frame_args=thr_idxs,
+    )
 
 
-def center_detection(all_img_arr, all_labeled, thr_idxs):
-    all_img_arr = np.asarray(all_img_arr)
+def filter_statistics(all_stats, vol_threshold=1):
+    """
+    Noise removal on statistics tables: keeps the components with more
+    than ``vol_threshold`` voxels in every frame.
+    """
+    return [stats[stats.count > vol_threshold] for stats in all_stats]
 
-    all_centers_noisefree = []
-    for frames in tqdm(range(all_img_arr.shape[0]), desc="Detecting the center of components."):
-        all_centers_noisefree.append(center_of_mass(all_img_arr[frames], labels=all_labeled[frames], index=thr_idxs[frames]))
 
-    return all_centers_noisefree
+def center_detection(all_img_arr, all_labeled, thr_idxs, workers=1):
+    """
+    Intensity weighted centers of the components listed in ``thr_idxs`` for
+    every frame, as one (n, 3) array per frame. Frames are processed by
+    ``workers`` processes (``None`` uses every core).
+    """
+    all_stats = frame_statistics(all_img_arr, all_labeled, thr_idxs, workers=workers)
+    return [stats.centroid for stats in all_stats]
 
 
-def tracker(all_centers):
-    all_cen = all_centers
-    new_objects = [[(0, x)] for x in all_centers[0]]
+def iter_frame_statistics(all_image_arr, vol_threshold=1, intensity_arr=None):
+    """
+    Streaming version of ``ccl_3d`` -> ``noise_removal`` -> ``center_detection``.
+    Every frame is labeled into a reused single-frame buffer, measured with
+    ``object_statistics`` and size filtered, and only the statistics table
+    is kept, so peak memory stays around one frame no matter how long the
+    movie is (``all_image_arr`` can be a memory-mapped or lazily loaded
+    array).
+    Parameters
+    ----------
+    all_image_arr : array, shape (T, Z, Y, X)
+        Binary (or thresholded) movie; it is also used as centroid weights
+        unless ``intensity_arr`` is given.
+    vol_threshold : integer
+        Components with at most this many voxels are removed.
+    intensity_arr : array, shape (T, Z, Y, X), optional
+        Intensities for the centroid weights and the mean intensity.
+    Yields
+    ------
+    frame : integer
+        Frame index.
+    stats : record array
+        Statistics of the kept components of the frame.
+    """
+    from scipy.ndimage import label
+
+    structure = np.ones((3, 3, 3), dtype=int)
+    if intensity_arr is None:
+        intensity_arr = all_image_arr
 
-    t_limit = 20
+    labeled = None
+    for frame in range(len(all_image_arr)):
+        image = np.asarray(all_image_arr[frame])
+        if labeled is None:
+            labeled = np.empty(image.shape, dtype=label_dtype(np.prod([(s + 1) // 2 for s in image.shape])))
+        label(image, structure, output=labeled)
+        stats = object_statistics(intensity_arr[frame], labeled)
+        yield frame, stats[stats.count > vol_threshold]
 
-    for i in tqdm(range(1, len(all_cen) - 1), desc="Tracking..."):
-        current_frame = all_cen[i]
-        last_known_centers = [obj[-1][1] for obj in new_objects if len(obj) > 0]
-        cost = distance.cdist(last_known_centers, current_frame, "euclidean")
-        obj_ids, new_centers_ind = linear_sum_assignment(cost)
 
-        all_center_inds = set(range(len(current_frame)))
+def stream_centers(all_image_arr, vol_threshold=1, intensity_arr=None):
+    """
+    Runs ``iter_frame_statistics`` over the whole movie.
+    Returns
+    -------
+    all_centers_noisefree : list of arrays, shape (n, 3)
+        Centroids of the kept components per frame, as ``center_detection``.
+    all_stats : list of record arrays
+        The per-frame statistics tables.
+    """
+    all_stats = [stats for _, stats in progress_iter(iter_frame_statistics(all_image_arr, vol_threshold, intensity_arr), total=len(all_image_arr), desc="Streaming center detection")]
+    return [stats.centroid for stats in all_stats], all_stats
+
+
+def _gated_assignment(track_centers, detections, t_limit):
+    """
+    Solves the track/detection assignment only among pairs closer than
+    ``t_limit``. Candidate pairs come from a KD-tree query and every
+    connected component of the resulting bipartite graph is solved on its
+    own, so the cost stays near-linear in the number of detections instead
+    of growing with (tracks x detections).
+    Returns
+    -------
+    obj_ids, new_centers_ind : integer arrays
+        Matched track and detection indices.
+    """
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+    from scipy.spatial import cKDTree
+
+    pairs = cKDTree(track_centers).sparse_distance_matrix(cKDTree(detections), t_limit, output_type="ndarray")
+    if len(pairs) == 0:
+        return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp)
+    rows, cols, dist = pairs["i"].astype(np.intp), pairs["j"].astype(np.intp), pairs["v"]
+
+    # tracks are nodes 0..n_tracks-1 of the bipartite graph, detections follow
+    n_tracks, n_nodes = len(track_centers), len(track_centers) + len(detections)
+    graph = coo_matrix((np.ones(len(rows)), (rows, cols + n_tracks)), shape=(n_nodes, n_nodes))
+    _, component = connected_components(graph, directed=False)
+    edge_component = component[rows]
+    edges_per_component = np.bincount(edge_component)
+
+    # a component with a single edge is a lone track/detection pair
+    single = edges_per_component[edge_component] == 1
+    obj_ids, new_centers_ind = [rows[single]], [cols[single]]
+
+    multi = np.flatnonzero(~single)
+    multi = multi[np.argsort(edge_component[multi], kind="stable")]
+    for edges in np.split(multi, np.flatnonzero(np.diff(edge_component[multi])) + 1):
+        if len(edges) == 0:
+            continue
+        track_ids, r = np.unique(rows[edges], return_inverse=True)
+        center_ids, c = np.unique(cols[edges], return_inverse=True)
+        # pairs outside the gate get a cost higher than any set of gated
+        # pairs, so the solver first maximizes the number of gated matches
+        shape = (len(track_ids), len(center_ids))
+        cost = np.full(shape, t_limit * (min(shape) + 1) + 1.0)
+        gated = np.zeros(shape, dtype=bool)
+        cost[r, c] = dist[edges]
+        gated[r, c] = True
+        r, c = linear_sum_assignment(cost)
+        keep = gated[r, c]
+        obj_ids.append(track_ids[r[keep]])
+        new_centers_ind.append(center_ids[c[keep]])
+
+    return np.concatenate(obj_ids), np.concatenate(new_centers_ind)
+
+
+class TrackTable:
+    """
+    Columnar storage of tracks: one row per tracked point in the contiguous
+    arrays ``track_id``, ``t``, ``z``, ``y`` and ``x`` (``z, y, x`` being axes
+    0, 1 and 2 of the centers), sorted by track and time. The points of
+    track ``i`` are the rows ``offsets[i]:offsets[i + 1]``.
+    """
 
-        for obj_id, new_center_ind in zip(obj_ids, new_centers_ind):
-            if (
-                distance.euclidean(
-                    np.array(current_frame[new_center_ind]),
-                    np.array(new_objects[obj_id][-1][1]),
-                )
-                <= t_limit
-            ):
-                all_center_inds.remove(new_center_ind)
-                new_objects[obj_id].append((i, current_frame[new_center_ind]))
+    def __init__(self, track_id, t, z, y, x, offsets):
+        self.track_id = track_id
+        self.t = t
+        self.z = z
+        self.y = y
+        self.x = x
+        self.offsets = offsets
+
+    @classmethod
+    def from_tracks(cls, tracks):
+        """
+        Builds the table from a list of tracks, each a list of
+        ``(frame, center)`` pairs.
+        """
+        lengths = np.fromiter((len(track) for track in tracks), dtype=np.intp, count=len(tracks))
+        offsets = np.zeros(len(tracks) + 1, dtype=np.intp)
+        np.cumsum(lengths, out=offsets[1:])
+        t = np.fromiter((frame for track in tracks for frame, _ in track), dtype=np.intp, count=offsets[-1])
+        centers = np.asarray([center for track in tracks for _, center in track], dtype=np.float64)
+        if len(centers) == 0:
+            centers = np.zeros((0, 3))
+        track_id = np.repeat(np.arange(len(tracks), dtype=np.intp), lengths)
+        return cls(track_id, t, centers[:, 0].copy(), centers[:, 1].copy(), centers[:, 2].copy(), offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def lengths(self):
+        """Number of points of every track."""
+        return np.diff(self.offsets)
+
+    def napari_tracks(self):
+        """
+        Returns the (N, 5) ``[track_id, t, z, y, x]`` array a napari
+        ``Tracks`` layer expects.
+        """
+        return np.column_stack([self.track_id, self.t, self.z, self.y, self.x])
+
+    def to_lists(self):
+        """
+        Returns the ragged ``(xx, yy, zz)`` lists ``tracker`` used to return,
+        where ``xx`` holds axis 1 (``y``), ``yy`` axis 2 (``x``) and ``zz``
+        axis 0 (``z``).
+        """
+        if len(self) == 0:
+            return ([], [], [])
+        bounds = self.offsets[1:-1]
+        return tuple([part.tolist() for part in np.split(column, bounds)] for column in (self.y, self.x, self.z))
+
+    def complete_tracks(self, frame_number):
+        """
+        Returns the ``(xx, yy, zz)`` coordinates, as (n, frame_number)
+        arrays, of the tracks that are exactly ``frame_number`` points long.
+        """
+        complete = np.flatnonzero(self.lengths == frame_number)
+        rows = (self.offsets[complete, None] + np.arange(frame_number)).ravel()
+        return tuple(column[rows].reshape(len(complete), frame_number) for column in (self.y, self.x, self.z))
+
+    def runs(self):
+        """
+        Splits the tracks into runs of consecutive frames: a track that
+        skips frames (see ``tracker``'s ``max_gap``) is cut at every gap.
+        Returns
+        -------
+        track_index : array, shape (n,)
+            Track of every run.
+        starts, ends : arrays, shape (n,)
+            Row range ``starts[i]:ends[i]`` of every run.
+        """
+        breaks = np.flatnonzero((np.diff(self.t) != 1) | (np.diff(self.track_id) != 0)) + 1
+        starts = np.concatenate([[0], breaks]).astype(np.intp)
+        ends = np.concatenate([breaks, [len(self.t)]]).astype(np.intp)
+        if len(self.t) == 0:
+            starts, ends = starts[:0], ends[:0]
+        return self.track_id[starts], starts, ends
+
+    def windows(self, window, step=1):
+        """
+        Cuts every run of at least ``window`` consecutive frames (see
+        ``runs``) into windows of ``window`` points, starting every ``step``
+        points from the start of the run, so no window spans a gap.
+        Returns
+        -------
+        track_index : array, shape (n,)
+            Track of every window.
+        xx, yy, zz : arrays, shape (n, window)
+            Coordinates of the windows, in the order of ``complete_tracks``.
+        """
+        track_index, starts = [], []
+        for track, start, end in zip(*self.runs()):
+            if end - start < window:
+                continue
+            run_starts = np.arange(start, end - window + 1, step)
+            track_index.append(np.full(len(run_starts), track, dtype=np.intp))
+            starts.append(run_starts)
+        track_index = np.concatenate(track_index) if track_index else np.zeros(0, dtype=np.intp)
+        starts = np.concatenate(starts) if starts else np.zeros(0, dtype=np.intp)
+        rows = (starts[:, None] + np.arange(window)).ravel()
+        return (track_index,) + tuple(column[rows].reshape(len(starts), window) for column in (self.y, self.x, self.z))
+
+
+class Tracker:
+    """
+    Incremental tracker for frames that arrive one at a time, e.g. during a
+    live acquisition. Feed every frame's centers to ``update`` and call
+    ``finalize`` to get the tracks; ``tracker`` runs exactly this on a full
+    list of frames.
+    Parameters
+    ----------
+    t_limit : float
+        Largest distance a center can move between two frames.
+    method : {"dense", "gated"}
+        Assignment method, see ``tracker``.
+    max_gap : integer, optional
+        Tracks left unmatched for more than ``max_gap`` consecutive frames
+        are finished and no longer take part in the assignment.
+    """
 
-        for new_center_ind in all_center_inds:
-            new_objects.append([(i, current_frame[new_center_ind])])
-    xx = [[]]
-    yy = [[]]
-    zz = [[]]
-    for i in range(len(new_objects)):
-        for j in range(len(new_objects[i])):
-            zz[i].append(new_objects[i][j][1][0])
-            xx[i].append(new_objects[i][j][1][1])
-            yy[i].append(new_objects[i][j][1][2])
-        xx.append([])
-        zz.append([])
-        yy.append([])
+    def __init__(self, t_limit=20, method="dense", max_gap=None):
+        if method not in ("dense", "gated"):
+            raise ValueError(f'Unknown tracking method "{method}", expected "dense" or "gated".')
+        self.t_limit = t_limit
+        self.method = method
+        self.max_gap = max_gap
+        # every track as a list of (frame, center) pairs, in creation order
+        self._tracks = []
+        # indices (into _tracks) of the tracks still open for matching;
+        # the others are finished and only kept for the output
+        self._active = []
+
+    @property
+    def n_active(self):
+        """Number of tracks still open for matching."""
+        return len(self._active)
+
+    def update(self, frame_index, centers):
+        """
+        Links the centers of frame ``frame_index`` to the active tracks;
+        unmatched centers start new tracks.
+        Returns
+        -------
+        track_ids : integer array
+            Track of every center of the frame.
+        """
+        if self.max_gap is not None:
+            self._active = [obj for obj in self._active if frame_index - self._tracks[obj][-1][0] - 1 <= self.max_gap]
+        last_known_centers = [self._tracks[obj][-1][1] for obj in self._active]
+
+        track_ids = np.full(len(centers), -1, dtype=np.intp)
+
+        if len(centers) and len(last_known_centers):
+            if self.method == "gated":
+                obj_ids, new_centers_ind = _gated_assignment(np.asarray(last_known_centers), np.asarray(centers), self.t_limit)
+            else:
+                cost = distance.cdist(last_known_centers, centers, "euclidean")
+                obj_ids, new_centers_ind = linear_sum_assignment(cost)
+                within_limit = cost[obj_ids, new_centers_ind] <= self.t_limit
+                obj_ids, new_centers_ind = obj_ids[within_limit], new_centers_ind[within_limit]
+
+            for obj_id, new_center_ind in zip(obj_ids, new_centers_ind):
+                track_ids[new_center_ind] = self._active[obj_id]
+                self._tracks[self._active[obj_id]].append((frame_index, centers[new_center_ind]))
+
+        for new_center_ind in np.flatnonzero(track_ids < 0):
+            track_ids[new_center_ind] = len(self._tracks)
+            self._active.append(len(self._tracks))
+            self._tracks.append([(frame_index, centers[new_center_ind])])
+
+        return track_ids
+
+    def finalize(self):
+        """
+        Returns every track seen so far, finished or not, as a ``TrackTable``.
+        """
+        return TrackTable.from_tracks(self._tracks)
+
+
+def tracker(all_centers, t_limit=20, method="dense", max_gap=None, as_table=False):
+    """
+    Links the centers of consecutive frames into tracks.
+    Parameters
+    ----------
+    all_centers : list
+        Centers of every frame, as returned by ``center_detection``.
+    t_limit : float
+        Largest distance a center can move between two frames.
+    method : {"dense", "gated"}
+        "dense" solves one assignment between every track and every center
+        of the frame and drops the pairs further apart than ``t_limit``.
+        "gated" only considers pairs within ``t_limit`` (KD-tree query plus
+        one small assignment per group of competing pairs), which is much
+        faster for crowded frames.
+    max_gap : integer, optional
+        Tracks left unmatched for more than ``max_gap`` consecutive frames
+        are finished and no longer take part in the assignment, which keeps
+        the per-frame cost flat on long movies. By default tracks are never
+        finished.
+    as_table : bool
+        Return the tracks as a columnar ``TrackTable`` instead of lists.
+    Returns
+    -------
+    xx, yy, zz : lists
+        Coordinates of every track along axis 1, 2 and 0 of the centers
+        (``TrackTable.to_lists``), or the ``TrackTable`` with ``as_table``.
+    """
+    online = Tracker(t_limit=t_limit, method=method, max_gap=max_gap)
+    for i in progress_iter(range(len(all_centers)), desc="Tracking..."):
+        online.update(i, all_centers[i])
 
-    zz = [pick for pick in zz if len(pick) > 0]
-    xx = [pick for pick in xx if len(pick) > 0]
-    yy = [pick for pick in yy if len(pick) > 0]
+    table = online.finalize()
+    if as_table:
+        return table
+    return table.to_lists()
 
-    return (xx, yy, zz)
 
+def preprocessing_for_clustering(x, y=None, z=None, frame_number=None, object_numbers=None):
+    """
+    Keeps only the trajectories that span ``frame_number`` frames.
+    ``x`` is either the ``xx`` list returned by ``tracker`` (with ``y``, ``z``
+    and ``object_numbers`` given as well) or a ``TrackTable``, in which case
+    the kept trajectories are returned as (n, frame_number) arrays.
+    """
+    if isinstance(x, TrackTable):
+        return x.complete_tracks(frame_number)
 
-def preprocessing_for_clustering(x, y, z, frame_number, object_numbers):
     newxx = []
     newyy = []
     newzz = []
@@ -249,6 +797,46 @@ def train(X, order=2):
     return matrices
 
 
+def train_batch(X, frame_numbers, order=2):
+    """
+    Fits the AR model of ``train`` to every trajectory at once.
+    The lagged design matrices of all trajectories are built as strided
+    views (no copy per trajectory) and all least-squares problems are
+    solved by one stacked pseudo-inverse.
+    Parameters
+    ----------
+    X : array, shape (q, N * frame_numbers)
+        State-space data of N trajectories of ``frame_numbers`` points each,
+        laid out one trajectory after the other.
+    frame_numbers : integer
+        Length of every trajectory.
+    order : integer
+        Positive, non-zero integer order value for the order of the Markov process.
+    Returns
+    -------
+    flatten_AR_mat : array, shape (N, order * q * q)
+        The flattened transition matrices of every trajectory, identical to
+        ``np.concatenate([A.flatten() for A in train(traj, order)])``.
+    """
+    from numpy.lib.stride_tricks import sliding_window_view
+
+    if order <= 0:
+        raise Exception('Parameter "order" restricted to positive integer values')
+    q = X.shape[0]
+    trajectories = X.reshape(q, -1, frame_numbers).transpose(1, 0, 2)
+    n = trajectories.shape[0]
+
+    # windows[k, :, t, l] = trajectories[k, :, t + l]
+    windows = sliding_window_view(trajectories, order + 1, axis=2)
+    # block i - 1 of W holds the lag-i values, i.e. window position order - i
+    W = windows[..., order - 1 :: -1]
+    W = W.transpose(0, 3, 1, 2).reshape(n, order * q, frame_numbers - order)
+    Xt = windows[..., order]
+    A = np.matmul(Xt, np.linalg.pinv(W))
+
+    return A.reshape(n, q, order, q).transpose(0, 2, 1, 3).reshape(n, order * q * q)
+
+
 def martin(A1, C1, A2, C2):
     """
     Computes the pairwise Martin distance between two d-order AR systems.
@@ -264,6 +852,14 @@ def martin(A1, C1, A2, C2):
     m : float
         Martin distance between the two systems.
     """
+    return _martin_from_gramians(*_martin_gramians(A1, C1, A2, C2))
+
+
+def _martin_gramians(A1, C1, A2, C2):
+    """
+    Solves the Lyapunov equation of the joint system of ``martin`` and
+    returns its blocks ``P11, P12, P22``.
+    """
     N, q = C1.shape
     d = len(A1)
     # print(N, q, d)
@@ -302,7 +898,15 @@ def martin(A1, C1, A2, C2):
         X[: (q * d), (q * d) :],
         X[(q * d) :, (q * d) :],
     )
-    PPP = sla.inv(P11).dot(P12).dot(sla.inv(P22)).dot(P12.T)
+    return P11, P12, P22
+
+
+def _martin_from_gramians(P11, P12, P22):
+    return _martin_from_inverses(sla.inv(P11), P12, sla.inv(P22))
+
+
+def _martin_from_inverses(P11_inv, P12, P22_inv):
+    PPP = P11_inv.dot(P12).dot(P22_inv).dot(P12.T)
 
     w = sla.eigvalsh(PPP)
     maxpp = w.flatten().max()
@@ -314,92 +918,697 @@ def martin(A1, C1, A2, C2):
     return -np.log(w.prod())
 
 
-def computing_affinity(traj_pool, frame_numbers, flatten_AR_mat, number_of_points, ar_order):
-    # first We create a trajectory pool with the dimensions of 3x(Num_of_trajectoris)x(Num_of_frames)
-    all_traj_mat = traj_pool.copy()
-    all_traj_mat = all_traj_mat.reshape(all_traj_mat.shape[0], all_traj_mat.shape[1] * all_traj_mat.shape[2])
-    print(all_traj_mat.shape)
+def _companion(A, q):
+    """
+    Block companion matrix of a d-order AR system, the per-system diagonal
+    block of the joint matrix built in ``martin``.
+    """
+    d = len(A)
+    F = np.zeros(shape=(q * d, q * d))
+    for i, a in enumerate(A):
+        F[:q, (i * q) : (i * q) + q] = a
+    if d > 1:
+        F[q:, : (d - 1) * q] = np.identity(q * (d - 1))
+    return F
+
+
+def martin_system(A, C):
+    """
+    Precomputes everything ``martin`` needs from a single system, so that
+    pairwise distances only cost a small Sylvester solve per pair.
+
+    The joint matrix of ``martin`` is block diagonal, so the diagonal blocks
+    of its Lyapunov solution are the per-system Gramians and the cross block
+    solves the Stein equation ``P12 = F1 P12 F2^T + Ct1^T Ct2``. The Cayley
+    transform ``Fc = (F + I)^-1 (F - I)`` turns the latter into the Sylvester
+    equation ``Fc1 P12 + P12 Fc2^T = -2 (F1 + I)^-1 Ct1^T Ct2 (F2 + I)^-T``,
+    solved with the cached real Schur form of every ``Fc``.
+    Parameters
+    ----------
+    A : list
+        AR parameters of the system (as passed to ``martin``).
+    C : array, shape (N, q)
+        Subspace of the system.
+    Returns
+    -------
+    P_inv, S, U, L : arrays
+        Inverse Gramian, Schur form ``Fc = U S U^T`` and the projected
+        right-hand side factor ``L = U^T (F + I)^-1 Ct^T``.
+    """
+    N, q = C.shape
+    F = _companion(A, q)
+    Ct = np.kron(np.identity(len(A)), C)
+    P = sla.solve_discrete_lyapunov(F, Ct.T.dot(Ct))
+    P = (P + P.T) * 0.5
+
+    identity = np.identity(len(F))
+    G = sla.inv(F + identity)
+    S, U = sla.schur(G.dot(F - identity))
+    L = U.T.dot(G).dot(Ct.T)
+    return sla.inv(P), S, U, L
+
+
+def _martin_cross_gramian(S1, U1, L1, S2, U2, L2):
+    Y, scale, _ = sla.lapack.dtrsyl(S1, S2, -2.0 * L1.dot(L2.T), tranb="T")
+    return U1.dot(Y / scale).dot(U2.T)
+
+
+def martin_from_systems(system1, system2):
+    """
+    ``symmetric_martin`` of two systems precomputed by ``martin_system``.
+    """
+    P11_inv, S1, U1, L1 = system1
+    P22_inv, S2, U2, L2 = system2
+    P12 = _martin_cross_gramian(S1, U1, L1, S2, U2, L2)
+    return 0.5 * (_martin_from_inverses(P11_inv, P12, P22_inv) + _martin_from_inverses(P22_inv, P12.T, P11_inv))
+
+
+def symmetric_martin(A1, C1, A2, C2):
+    """
+    Mean of ``martin(A1, C1, A2, C2)`` and ``martin(A2, C2, A1, C1)``, the
+    value the symmetrized distance matrix holds. The two orders differ
+    numerically (``eigvalsh`` only reads one triangle of a non-symmetric
+    product), but the swapped joint system's Gramian is a block permutation
+    of the original one, so a single Lyapunov solve serves both.
+    """
+    P11, P12, P22 = _martin_gramians(A1, C1, A2, C2)
+    return 0.5 * (_martin_from_gramians(P11, P12, P22) + _martin_from_gramians(P22, P12.T, P11))
+
+
+def _martin_block(task, flatten_AR_mat, C, block):
+    """
+    Symmetrized Martin distances of one tile ``block = ((r0, r1), (c0, c1))``
+    of the upper triangle; pairs on or below the diagonal are left at zero.
+    """
+    (r0, r1), (c0, c1) = block
+    tile = np.zeros((r1 - r0, c1 - c0))
+    for i in range(r0, r1):
+        for j in range(max(c0, i + 1), c1):
+            tile[i - r0, j - c0] = symmetric_martin(flatten_AR_mat[i], C, flatten_AR_mat[j], C)
+    return tile
+
+
+def _martin_systems_block(task, P_inv, S, U, L, block):
+    """
+    Same as ``_martin_block`` from the stacked ``martin_system`` factors.
+    """
+    (r0, r1), (c0, c1) = block
+    tile = np.zeros((r1 - r0, c1 - c0))
+    for i in range(r0, r1):
+        for j in range(max(c0, i + 1), c1):
+            tile[i - r0, j - c0] = martin_from_systems((P_inv[i], S[i], U[i], L[i]), (P_inv[j], S[j], U[j], L[j]))
+    return tile
+
+
+def _store_tile(Mrt_dist_mat, block, tile):
+    """Writes an upper-triangle tile and its mirror image below the diagonal."""
+    (r0, r1), (c0, c1) = block
+    if r0 == c0:
+        Mrt_dist_mat[r0:r1, c0:c1] = tile + tile.T
+    else:
+        Mrt_dist_mat[r0:r1, c0:c1] = tile
+        Mrt_dist_mat[c0:c1, r0:r1] = tile.T
+
+
+def _open_checkpoint(path, shape, key):
+    """
+    Opens the memory-mapped ``.npy`` file at ``path`` for a block-wise
+    computation, together with the manifest of its finished blocks
+    (``<path>.manifest.json``). An existing file is only resumed when the
+    manifest was written for the same ``key``, otherwise it is started over.
+    Returns
+    -------
+    array : np.memmap
+        The output matrix.
+    completed : list
+        Finished blocks, as ``[row_start, column_start]`` pairs.
+    manifest : Path
+        Path of the manifest.
+    """
+    path = Path(path)
+    manifest = path.with_name(path.name + ".manifest.json")
+    if path.exists() and manifest.exists():
+        record = json.loads(manifest.read_text())
+        if record.get("key") == key:
+            array = np.lib.format.open_memmap(path, mode="r+")
+            if array.shape == tuple(shape):
+                return array, record["completed"], manifest
+    path.parent.mkdir(parents=True, exist_ok=True)
+    array = np.lib.format.open_memmap(path, mode="w+", dtype=np.float64, shape=tuple(shape))
+    _write_manifest(manifest, key, [])
+    return array, [], manifest
+
+
+def _write_manifest(manifest, key, completed):
+    # write then rename, so a crash never leaves a truncated manifest behind
+    tmp = manifest.with_name(manifest.name + ".tmp")
+    tmp.write_text(json.dumps({"key": key, "completed": completed}))
+    os.replace(tmp, manifest)
+
+
+def pairwise_martin(flatten_AR_mat, C, workers=1, block_size=32, blas_threads=1, method="sylvester", out=None):
+    """
+    Computes the symmetrized matrix of pairwise Martin distances between the
+    AR systems in ``flatten_AR_mat`` (sharing the projection ``C``), i.e.
+    ``symmetric_martin`` for every pair. Only the upper triangle is
+    computed, in tiles of ``block_size`` x ``block_size`` pairs spread over
+    ``workers`` processes. Each process is limited to ``blas_threads`` BLAS
+    threads to avoid oversubscription.
+    Parameters
+    ----------
+    method : {"sylvester", "lyapunov"}
+        "sylvester" solves the Gramian of every system once
+        (``martin_system``) and only a small Sylvester equation per pair;
+        "lyapunov" solves the full joint Lyapunov equation of every pair as
+        ``martin`` does. Both agree to numerical tolerance.
+    out : array or path, optional
+        Output buffer. A path is used as a resumable, memory-mapped ``.npy``
+        file: every finished tile is flushed to it and recorded in
+        ``<out>.manifest.json``, and a rerun on the same systems only
+        computes the tiles that are missing.
+    Returns
+    -------
+    Mrt_dist_mat : array, shape (N, N)
+        Distance matrix with a zero diagonal.
+    """
+    n = flatten_AR_mat.shape[0]
+    bounds = [(start, min(start + block_size, n)) for start in range(0, n, block_size)]
+    blocks = [(rows, cols) for r, rows in enumerate(bounds) for cols in bounds[r:]]
+
+    if out is None or hasattr(out, "shape"):
+        Mrt_dist_mat = _output_buffer(out, (n, n), np.float64)
+        completed, manifest = [], None
+    else:
+        fingerprint = hashlib.sha1(np.ascontiguousarray(flatten_AR_mat, dtype=np.float64).tobytes() + np.ascontiguousarray(C, dtype=np.float64).tobytes()).hexdigest()
+        key = {"systems": fingerprint, "block_size": block_size}
+        Mrt_dist_mat, completed, manifest = _open_checkpoint(out, (n, n), key)
+    finished = {tuple(start) for start in completed}
+    blocks = [block for block in blocks if (block[0][0], block[1][0]) not in finished]
+
+    if method == "sylvester":
+        systems = [martin_system(A, C) for A in progress_iter(flatten_AR_mat, desc="Martin system Gramians")] if blocks else []
+        block_func = _martin_systems_block
+        arrays = tuple(np.stack(factor) for factor in zip(*systems)) if systems else (np.zeros((0, 0, 0)),) * 4
+    elif method == "lyapunov":
+        block_func = _martin_block
+        arrays = (flatten_AR_mat, C)
+    else:
+        raise ValueError(f'Unknown Martin distance method "{method}", expected "sylvester" or "lyapunov".')
+
+    def store(task, tile):
+        block = blocks[task]
+        _store_tile(Mrt_dist_mat, block, tile)
+        if manifest is not None:
+            Mrt_dist_mat.flush()
+            completed.append([block[0][0], block[1][0]])
+            _write_manifest(manifest, key, completed)
+
+    map_frames(
+        block_func,
+        arrays,
+        len(blocks),
+        workers=workers,
+        backend="process",
+        desc="Martin distances",
+        frame_args=blocks,
+        blas_threads=blas_threads,
+        callback=store,
+        # a resumed run starts its progress at the blocks already done
+        initial=len(finished),
+    )
+    return Mrt_dist_mat
+
+
+def martin_similarity(Mrt_dist_mat, normalized=False, out=None, block_rows=512):
+    """
+    Converts a distance matrix into the similarity ``exp(-0.5 * d / d.std())``
+    row block by row block, so memory-mapped matrices never have to be
+    loaded as a whole.
+    Parameters
+    ----------
+    normalized : bool
+        Uses the symmetric normalized laplacian of the distances (see
+        ``laplacian``), with a zero diagonal, as ``d``.
+    out : array or path, optional
+        Output buffer, a path creates a memory-mapped ``.npy`` file.
+    block_rows : integer
+        Number of rows processed at once.
+    Returns
+    -------
+    similarity : array, shape (N, N)
+    """
+    n = Mrt_dist_mat.shape[0]
+    row_blocks = [(start, min(start + block_rows, n)) for start in range(0, n, block_rows)]
+    scale = np.ones(n)
+    if normalized:
+        w = np.zeros(n)
+        for r0, r1 in row_blocks:
+            w += np.asarray(Mrt_dist_mat[r0:r1]).sum(axis=0)
+        scale = w ** (-0.5)
+
+    def distances(r0, r1):
+        d = np.asarray(Mrt_dist_mat[r0:r1], dtype=np.float64)
+        if normalized:
+            d = scale[r0:r1, None] * d * scale[None, :]
+            d[np.arange(r1 - r0), np.arange(r0, r1)] = 0.0
+        return d
+
+    # two passes for a numerically stable standard deviation
+    mean = sum(distances(r0, r1).sum() for r0, r1 in row_blocks) / (n * n)
+    std = np.sqrt(sum(((distances(r0, r1) - mean) ** 2).sum() for r0, r1 in row_blocks) / (n * n))
+
+    similarity = _output_buffer(out, (n, n), np.float64)
+    for r0, r1 in progress_iter(row_blocks, desc="Martin similarity"):
+        similarity[r0:r1] = np.exp(-0.5 * distances(r0, r1) / std)
+    if isinstance(similarity, np.memmap):
+        similarity.flush()
+    return similarity
+
+
+def _martin_pairs_block(task, P_inv, S, U, L, pairs):
+    """
+    Symmetrized Martin distances of an (n, 2) array of index pairs from the
+    stacked ``martin_system`` factors.
+    """
+    return np.array([martin_from_systems((P_inv[i], S[i], U[i], L[i]), (P_inv[j], S[j], U[j], L[j])) for i, j in pairs])
+
+
+def ar_features(traj_pool, frame_numbers, ar_order):
+    """
+    State-space projection and AR fit of a trajectory pool of shape
+    (3, Num_of_trajectories, Num_of_frames).
+    Returns
+    -------
+    flatten_AR_mat : array, shape (Num_of_trajectories, ar_order * 4)
+        Flattened AR parameters of every trajectory.
+    X, C : arrays
+        State-space data and projection matrix (see ``state_space``).
+    """
+    all_traj_mat = traj_pool.reshape(traj_pool.shape[0], traj_pool.shape[1] * traj_pool.shape[2])
+    X, C = state_space(all_traj_mat, 2)
+    return train_batch(X, frame_numbers, ar_order), X, C
 
+
+def knn_affinity(flatten_AR_mat, C, n_neighbors=10, workers=1, block_size=1024):
+    """
+    Sparse affinity between trajectories that only keeps, for every
+    trajectory, its ``n_neighbors`` nearest neighbours in AR-parameter
+    space. Martin distances are only computed for those pairs, so memory
+    and time grow with N * n_neighbors instead of N^2.
+    Parameters
+    ----------
+    flatten_AR_mat : array, shape (N, M)
+        Flattened AR parameters of every trajectory.
+    C : array
+        Shared projection matrix.
+    n_neighbors : integer
+        Number of neighbours kept per trajectory; the graph is symmetrized,
+        so a trajectory can end up with more.
+    workers : integer, optional
+        Number of parallel processes, ``None`` uses every core.
+    block_size : integer
+        Number of pairs per parallel task.
+    Returns
+    -------
+    similarity : scipy.sparse.csr_matrix, shape (N, N)
+        ``exp(-0.5 * d / d.std())`` of the kept Martin distances ``d``, with
+        ones on the diagonal like the dense similarity.
+    """
+    from scipy.sparse import coo_matrix
+    from scipy.spatial import cKDTree
+
+    n = flatten_AR_mat.shape[0]
+    k = min(n_neighbors, n - 1)
+    if k < 1:
+        return coo_matrix(np.ones((n, n))).tocsr()
+
+    _, neighbors = cKDTree(flatten_AR_mat).query(flatten_AR_mat, k=k + 1)
+    rows = np.repeat(np.arange(n), k + 1)
+    cols = neighbors.ravel()
+    pairs = np.unique(np.column_stack([np.minimum(rows, cols), np.maximum(rows, cols)]), axis=0)
+    pairs = pairs[pairs[:, 0] != pairs[:, 1]]
+
+    systems = [martin_system(A, C) for A in progress_iter(flatten_AR_mat, desc="Martin system Gramians")]
+    chunks = [pairs[start : start + block_size] for start in range(0, len(pairs), block_size)]
+    distances = map_frames(
+        _martin_pairs_block,
+        tuple(np.stack(factor) for factor in zip(*systems)),
+        len(chunks),
+        workers=workers,
+        backend="process",
+        desc="Martin distances",
+        frame_args=chunks,
+        blas_threads=1,
+    )
+    distances = np.concatenate(distances) if distances else np.zeros(0)
+
+    scale = distances.std() if len(distances) and distances.std() > 0 else 1.0
+    similarity = np.exp(-0.5 * distances / scale)
+    rows = np.concatenate([pairs[:, 0], pairs[:, 1], np.arange(n)])
+    cols = np.concatenate([pairs[:, 1], pairs[:, 0], np.arange(n)])
+    values = np.concatenate([similarity, similarity, np.ones(n)])
+    return coo_matrix((values, (rows, cols)), shape=(n, n)).tocsr()
+
+
+def sparse_affinity(traj_pool, frame_numbers, ar_order, n_neighbors=10, workers=1):
+    """
+    Sparse counterpart of ``computing_affinity``: AR features of the
+    trajectory pool and their ``knn_affinity``.
+    Returns
+    -------
+    similarity : scipy.sparse.csr_matrix
+        Sparse affinity for ``clustering``.
+    flatten_AR_mat : array
+        Flattened AR parameters of every trajectory.
+    (X, C) : arrays
+        State-space data and projection matrix.
+    """
+    flatten_AR_mat, X, C = ar_features(traj_pool, frame_numbers, ar_order)
+    similarity = knn_affinity(flatten_AR_mat, C, n_neighbors=n_neighbors, workers=workers)
+    return similarity, flatten_AR_mat, (X, C)
+
+
+def windowed_features(table, window, step=None, ar_order=2):
+    """
+    AR features of fixed-length sliding windows of the tracks in a
+    ``TrackTable``, so that the cost per track is bounded by its number of
+    windows and partial tracks are used as well. Windows only cover
+    consecutive frames (see ``TrackTable.windows``).
+    Parameters
+    ----------
+    window : integer
+        Number of points per window, more than ``ar_order``. A
+        ``ValueError`` is raised when no track has that many consecutive
+        frames.
+    step : integer, optional
+        Distance between window starts, defaults to ``window`` (no overlap).
+    Returns
+    -------
+    flatten_AR_mat : array, shape (n, ar_order * 4)
+        Flattened AR parameters of every window.
+    track_index : array, shape (n,)
+        Track of every window.
+    C : array
+        Projection matrix shared by all rows.
+    """
+    if window <= ar_order:
+        raise ValueError(f"A window of {window} points is too short for an AR model of order {ar_order}.")
+    window_track, xx, yy, zz = table.windows(window, step or window)
+    if not len(window_track):
+        _, starts, ends = table.runs()
+        longest = (ends - starts).max() if len(starts) else 0
+        raise ValueError(f"No track has {window} consecutive frames (the longest run has {longest}), choose a shorter window.")
+    flatten_AR_mat, X, C = ar_features(np.stack([xx, yy, zz]), window, ar_order)
+    return flatten_AR_mat, window_track, C
+
+
+def windowed_affinity(table, window, step=None, ar_order=2, aggregate="track", n_neighbors=0, workers=1):
+    """
+    Martin-distance similarity of the ``windowed_features`` of a
+    ``TrackTable``: dense (``exp(-0.5 * d / d.std())``) or, with
+    ``n_neighbors``, the sparse ``knn_affinity``.
+    Parameters
+    ----------
+    aggregate : {"track", "window"}
+        "track" averages the similarities of all window pairs of two tracks
+        into one track by track affinity, "window" keeps one row per window.
+    Returns
+    -------
+    similarity : array or scipy.sparse.csr_matrix
+        Affinity between tracks (or windows).
+    track_index : array
+        Track of every row of ``similarity``.
+    flatten_AR_mat : array
+        Flattened AR parameters of every window.
+    C : array
+        Projection matrix.
+    """
+    from scipy import sparse
+
+    if aggregate not in ("track", "window"):
+        raise ValueError(f'Unknown aggregation "{aggregate}", expected "track" or "window".')
+    flatten_AR_mat, window_track, C = windowed_features(table, window, step, ar_order)
+    if n_neighbors:
+        similarity = knn_affinity(flatten_AR_mat, C, n_neighbors=n_neighbors, workers=workers)
+    else:
+        similarity = martin_similarity(pairwise_martin(flatten_AR_mat, C, workers=workers))
+    if aggregate == "window":
+        return similarity, window_track, flatten_AR_mat, C
+
+    # mean over the window pairs of every two tracks: M^T S M, M[i, track] = 1 / number of windows
+    track_index, inverse = np.unique(window_track, return_inverse=True)
+    counts = np.bincount(inverse, minlength=len(track_index))
+    members = sparse.csr_matrix((1.0 / counts[inverse], (np.arange(len(inverse)), inverse)), shape=(len(inverse), len(track_index)))
+    similarity = members.T @ similarity @ members
+    return (similarity.tocsr() if sparse.issparse(similarity) else np.asarray(similarity)), track_index, flatten_AR_mat, C
+
+
+def computing_affinity(traj_pool, frame_numbers, flatten_AR_mat, number_of_points, ar_order, workers=1, out_dir=None):
+    """
+    Computes the Martin-distance based affinities of a trajectory pool of
+    shape (3, Num_of_trajectories, Num_of_frames). Pure computation, nothing
+    is printed or plotted; see ``plot_affinity`` to look at the result.
+    Parameters
+    ----------
+    flatten_AR_mat : array, shape (number_of_points, ar_order * 4)
+        Filled with the flattened AR parameters of every trajectory.
+    workers : integer, optional
+        Number of parallel processes for the distances.
+    out_dir : path, optional
+        Directory for checkpointed, memory-mapped distance and similarity
+        matrices (see ``pairwise_martin``).
+    Returns
+    -------
+    similarity1 : array, shape (N, N)
+        Similarity of the Martin distances.
+    similarity2 : array, shape (N, N)
+        Similarity of their normalized laplacian.
+    A_matrices : list
+        Transition matrices of the last trajectory.
+    (X, C) : arrays
+        State-space data and projection matrix.
+    """
     # Parameterization:
     # Then we set the AR dimensions to be 2 ( A dimensionality reduction ), so that the matrix C will be a 3x2 Matrix
     # and the matrix X will be a 2x(Num_of_trajectoris)x(Num_of_frames)
+    all_traj_mat = traj_pool.reshape(traj_pool.shape[0], traj_pool.shape[1] * traj_pool.shape[2])
     X, C = state_space(all_traj_mat, 2)
-    print("AR_Matrix, Projection_Matrix dims=", str(X.shape), str(C.shape))
-    for index in range(number_of_points):
-        traj2 = X[:, frame_numbers * index : (index + 1) * frame_numbers]
-        A_matrices = train(traj2, ar_order)
-        flatten_AR_mat[index] = np.concatenate([A.flatten() for A in A_matrices])
-    print(flatten_AR_mat.shape)
+    flatten_AR_mat[:number_of_points] = train_batch(X[:, : frame_numbers * number_of_points], frame_numbers, ar_order)
+    # transition matrices of the last trajectory, as train() returns them
+    A_matrices = list(flatten_AR_mat[number_of_points - 1].reshape(ar_order, X.shape[0], X.shape[0]))
 
     # Now let us create a pairwise Martin Distance:
+    # with an output directory the distances are checkpointed there and every matrix stays memory-mapped
+    out = (lambda name: None) if out_dir is None else (lambda name: Path(out_dir) / name)
+    Mrt_dist_mat = pairwise_martin(flatten_AR_mat, C, workers=workers, out=out("martin_distances.npy"))
 
-    Mrt_dist_mat = np.zeros(shape=(flatten_AR_mat.shape[0], flatten_AR_mat.shape[0]))
-    for i in range(flatten_AR_mat.shape[0]):
-        for j in range(flatten_AR_mat.shape[0]):
-            Mrt_dist_mat[i, j] = martin(flatten_AR_mat[i], C, flatten_AR_mat[j], C)
-            if i == 1 and j == 1:
-                print(Mrt_dist_mat[i, j])
-        print(i, j)
-    # ===========================================================================================================
-
-    Mrt_dist_mat = (Mrt_dist_mat.T + Mrt_dist_mat) * 0.5
-    for i in range(Mrt_dist_mat.shape[0]):
-        for j in range(Mrt_dist_mat.shape[1]):
-            if i == j:
-                Mrt_dist_mat[i, j] = 0.0
-    print(
-        'Check if any value in distance matrix in "Nan": ',
-        str(np.isnan(Mrt_dist_mat).any()),
-    )
-    print(
-        'Check if any value in distance matrix in "inf": ',
-        str(np.isinf(Mrt_dist_mat).any()),
-    )
+    # Converting the distance, and its normalized laplacian, to similarity:
+    similarity1 = martin_similarity(Mrt_dist_mat, out=out("similarity1.npy"))
+    similarity2 = martin_similarity(Mrt_dist_mat, normalized=True, out=out("similarity2.npy"))
+    return similarity1, similarity2, A_matrices, (X, C)
 
-    # Converting the distance to similarity:
-    similarity1 = np.exp(-0.5 * Mrt_dist_mat / Mrt_dist_mat.std())
 
-    # Now, Let us visualize the distance matrix:
-    fig = plt.figure(figsize=(15, 10))
-    plt.imshow(similarity1, cmap="Blues")
-    plt.colorbar()
-    plt.show()
+def plot_affinity(similarity1, similarity2=None, output_png_file=None, show=True):
+    """
+    Shows the affinities returned by ``computing_affinity``. matplotlib is
+    only imported here, so the computations do not depend on it.
+    """
+    from matplotlib import pyplot as plt
 
-    # Now, let us also compute the the Normal distance matrix too.
-    lap = laplacian(Mrt_dist_mat)
-    for i in range(Mrt_dist_mat.shape[0]):
-        for j in range(Mrt_dist_mat.shape[1]):
-            if i == j:
-                lap[i, j] = 0.0
-    lap = (lap + lap.T) * 0.5
-    var1 = lap
-    # Converting the distance to similarity:
-    similarity2 = np.exp(-0.5 * lap / lap.std())
-
-    print(np.isnan(lap).any())
-    print(np.isinf(lap).any())
-    plt.imshow(similarity2, cmap="hot")
-    plt.colorbar()
-    return similarity1, similarity2, A_matrices, (X, C)
+    panels = [(similarity1, "Blues")] + ([(similarity2, "hot")] if similarity2 is not None else [])
+    fig, axes = plt.subplots(1, len(panels), figsize=(15 * len(panels), 10), squeeze=False)
+    for ax, (similarity, cmap) in zip(axes[0], panels):
+        image = ax.imshow(similarity, cmap=cmap)
+        fig.colorbar(image, ax=ax)
+    if output_png_file is not None:
+        fig.savefig(output_png_file)
+    if show:
+        plt.show()
+    return fig
 
 
-def clustering(affinity, num_of_clusters, labels_file_name, affinity_file_name):
-    from sklearn.cluster import spectral_clustering
+def clustering(affinity, num_of_clusters, labels_file_name, affinity_file_name, eigen_solver=None, streamed=False):
+    """
+    Spectral clustering of a precomputed (dense or ``scipy.sparse``) affinity.
+    ``eigen_solver`` is passed to ``SpectralClustering``; sparse affinities
+    default to "arpack" so the eigenvectors are found without densifying
+    the matrix ("lobpcg" or "amg" work as well). Sparse affinities are
+    saved with ``scipy.sparse.save_npz``, all others with ``np.save``.
+
+    With ``streamed``, the labels come from a ``SpectralEmbedding`` instead,
+    which streams memory-mapped affinities (see ``computing_affinity``'s
+    ``out_dir``) in row blocks rather than loading them. It uses the same
+    discretization as ``SpectralClustering``, but its own eigensolver, so
+    the partitions can still differ slightly; the storage of the affinity
+    alone never changes the algorithm.
+    """
+    from scipy import sparse
     import sklearn.cluster as cluster
 
-    nclusters = num_of_clusters
-    scB = cluster.SpectralClustering(n_clusters=nclusters, affinity="precomputed", assign_labels="discretize")
-    # Mrt_dist_mat2 = (Mrt_dist_mat2 - np.mean(Mrt_dist_mat2, axis=0)) / np.std(Mrt_dist_mat2, axis=0)
-    scB.fit(affinity)
+    if streamed:
+        yB = SpectralEmbedding(affinity, num_of_clusters, eigen_solver=eigen_solver).labels(num_of_clusters)
+    else:
+        if eigen_solver is None and sparse.issparse(affinity):
+            eigen_solver = "arpack"
+
+        nclusters = num_of_clusters
+        scB = cluster.SpectralClustering(n_clusters=nclusters, affinity="precomputed", assign_labels="discretize", eigen_solver=eigen_solver)
+        # Mrt_dist_mat2 = (Mrt_dist_mat2 - np.mean(Mrt_dist_mat2, axis=0)) / np.std(Mrt_dist_mat2, axis=0)
+        scB.fit(affinity)
 
-    yB = scB.labels_
+        yB = scB.labels_
 
     np.save(labels_file_name, yB)
-    np.save(affinity_file_name, affinity)
+    if sparse.issparse(affinity):
+        sparse.save_npz(affinity_file_name, affinity.tocsr())
+    else:
+        np.save(affinity_file_name, affinity)
     return yB
 
 
+class SpectralEmbedding:
+    """
+    Spectral embedding of an affinity matrix, computed once for up to
+    ``max_clusters`` clusters so that the number of clusters can be swept
+    without recomputing the affinity or the eigen-decomposition.
+    ``eigenvalues`` are the largest eigenvalues of the normalized affinity
+    ``D^-1/2 W D^-1/2`` in descending order and ``eigenvectors`` the
+    matching columns. Sparse and memory-mapped affinities go through a
+    sparse eigensolver without being densified or loaded into memory.
+    """
+
+    def __init__(self, affinity, max_clusters=10, eigen_solver=None, random_state=0):
+        from scipy import sparse
+        from scipy.sparse.linalg import LinearOperator, eigsh
+
+        n = affinity.shape[0]
+        n_components = min(max_clusters + 1, n)
+        # a matrix too small for eigsh is loaded anyway
+        on_disk = isinstance(affinity, np.memmap) and n_components < n
+        row_blocks = [(start, min(start + 512, n)) for start in range(0, n, 512)]
+        if on_disk:
+            degree = np.concatenate([np.asarray(affinity[r0:r1]).sum(axis=1) for r0, r1 in row_blocks])
+        else:
+            degree = np.asarray(affinity.sum(axis=1)).ravel()
+        scale = 1 / np.sqrt(np.where(degree > 0, degree, 1))
+
+        if sparse.issparse(affinity):
+            normalized = sparse.diags(scale) @ affinity @ sparse.diags(scale)
+        elif on_disk:
+            # memory-mapped affinities are streamed through in row blocks for every product
+            def matvec(v):
+                v = scale * np.ravel(v)
+                return np.concatenate([scale[r0:r1] * (np.asarray(affinity[r0:r1]) @ v) for r0, r1 in row_blocks])
+
+            normalized = LinearOperator((n, n), matvec=matvec, dtype=np.float64)
+        else:
+            normalized = scale[:, None] * np.asarray(affinity) * scale[None, :]
+
+        if (sparse.issparse(normalized) or on_disk or eigen_solver == "arpack") and n_components < n:
+            eigenvalues, eigenvectors = eigsh(normalized, k=n_components, which="LA")
+        else:
+            dense = normalized.toarray() if sparse.issparse(normalized) else normalized
+            eigenvalues, eigenvectors = sla.eigh(dense, subset_by_index=[n - n_components, n - 1])
+        order = np.argsort(eigenvalues)[::-1]
+
+        self.eigenvalues = eigenvalues[order]
+        self.eigenvectors = eigenvectors[:, order]
+        self.max_clusters = n_components - 1 if n_components < n else n
+        self.random_state = random_state
+        self._scale = scale
+        self._labels = {}
+
+    @property
+    def eigengaps(self):
+        """
+        ``eigengaps[k - 1]`` is the gap between the k-th and (k+1)-th
+        smallest eigenvalue of the normalized Laplacian; a large gap
+        suggests k clusters.
+        """
+        return -np.diff(self.eigenvalues)
+
+    def embedding(self, num_of_clusters):
+        """Row-normalized leading ``num_of_clusters`` eigenvectors."""
+        vectors = self.eigenvectors[:, :num_of_clusters]
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.where(norms > 0, norms, 1)
+
+    def labels(self, num_of_clusters, assign_labels="discretize"):
+        """
+        Cluster labels for ``num_of_clusters`` clusters. "discretize" is the
+        label assignment of ``clustering`` (``SpectralClustering`` with
+        ``assign_labels="discretize"``) on the cached eigenvectors, "kmeans"
+        runs KMeans on the row-normalized ``embedding``.
+        """
+        from sklearn.cluster import KMeans
+        # the discretization SpectralClustering itself uses on its embedding
+        from sklearn.cluster._spectral import discretize
+
+        if not 1 <= num_of_clusters <= self.max_clusters:
+            raise ValueError(f"num_of_clusters has to be between 1 and {self.max_clusters}, got {num_of_clusters}.")
+        if assign_labels not in ("discretize", "kmeans"):
+            raise ValueError(f'Unknown label assignment "{assign_labels}", expected "discretize" or "kmeans".')
+        key = (num_of_clusters, assign_labels)
+        if key not in self._labels:
+            if assign_labels == "kmeans":
+                kmeans = KMeans(n_clusters=num_of_clusters, n_init=10, random_state=self.random_state)
+                self._labels[key] = kmeans.fit_predict(self.embedding(num_of_clusters))
+            else:
+                # sklearn's spectral_embedding: eigenvectors over sqrt(degree), signs made deterministic
+                maps = self.eigenvectors[:, :num_of_clusters] * self._scale[:, None]
+                maps *= np.sign(maps[np.abs(maps).argmax(axis=0), np.arange(num_of_clusters)])
+                self._labels[key] = discretize(maps, random_state=self.random_state)
+        return self._labels[key]
+
+    def silhouette(self, num_of_clusters, assign_labels="discretize", sample_size=2000):
+        """
+        Silhouette score of ``labels(num_of_clusters)`` in the embedding, NaN
+        when undefined. Estimated on ``sample_size`` random points, so it is
+        not quadratic in the number of trajectories (``None`` uses all).
+        """
+        from sklearn.metrics import silhouette_score
+
+        labels = self.labels(num_of_clusters, assign_labels)
+        if not 2 <= len(np.unique(labels)) < len(labels):
+            return np.nan
+        if sample_size is not None and sample_size >= len(labels):
+            sample_size = None
+        return silhouette_score(self.embedding(num_of_clusters), labels, sample_size=sample_size, random_state=self.random_state)
+
+    def sweep(self, cluster_numbers=None, assign_labels="discretize", sample_size=2000):
+        """
+        Labels and scores for every number of clusters in
+        ``cluster_numbers`` (default ``1..max_clusters``).
+        Returns
+        -------
+        results : dict
+            ``{k: (labels, eigengap, silhouette)}``.
+        """
+        if cluster_numbers is None:
+            cluster_numbers = range(1, self.max_clusters + 1)
+        gaps = self.eigengaps
+        return {k: (self.labels(k, assign_labels), gaps[k - 1] if k - 1 < len(gaps) else np.nan, self.silhouette(k, assign_labels, sample_size)) for k in cluster_numbers}
+
+
+def cluster_sweep(affinity, cluster_numbers, eigen_solver=None, random_state=0, assign_labels="discretize"):
+    """
+    Clusters ``affinity`` for every number of clusters in
+    ``cluster_numbers`` from a single spectral embedding.
+    Returns
+    -------
+    embedding : SpectralEmbedding
+        The embedding, to get more labels from later.
+    results : dict
+        ``{k: (labels, eigengap, silhouette)}``.
+    """
+    cluster_numbers = list(cluster_numbers)
+    embedding = SpectralEmbedding(affinity, max(cluster_numbers), eigen_solver=eigen_solver, random_state=random_state)
+    return embedding, embedding.sweep(cluster_numbers, assign_labels)
+
+
 def visualize_clusters(color_list, label, xx, yy, zz, output_png_file):
+    from matplotlib import pyplot as plt
+
     # Plotting the trajectories and showing the clustering using a specific color for each label
     col = color_list
     # for i in range(Number_of_points):
@@ -1,11 +1,14 @@
 import os
-from pathlib import Path
 from qtpy.QtWidgets import *
-from qtpy.QtCore import Qt
+from qtpy.QtCore import Qt, QTimer
 import tifffile
-from tseg.config import shared_config, TsegStyles  # Import shared_config
+from tseg.config import shared_config, session_temp_dir, TsegStyles  # Import shared_config
 
 from tseg.widgets.prep import *
+from tseg.widgets.task_runner import TaskRunner
+
+# normalizations that can use global statistics, by button text
+GLOBAL_NORMALIZATIONS = {"Min-Max": "minmax", "Scale to -1,+1": "scale", "Z-Score": "zscore"}
 
 
 class PreProcessingWidget(QWidget):
@@ -17,6 +20,34 @@ class PreProcessingWidget(QWidget):
         hintLabel = QLabel("Hint: Select the layer(s) you want to process in the layer list and then click the button.")
         layout.addWidget(hintLabel)
 
+        # long operations run in the background, clicking their button again cancels them
+        self.statusLabel = QLabel("")
+        layout.addWidget(self.statusLabel)
+        self.tasks = TaskRunner(self.statusLabel)
+
+        workersFormLayout = QFormLayout()
+        layout.addLayout(workersFormLayout)
+        self.workersSpinBox = QSpinBox()
+        self.workersSpinBox.setRange(1, os.cpu_count() or 1)
+        self.workersSpinBox.setValue(os.cpu_count() or 1)
+        self.workersSpinBox.setToolTip("Number of threads processing image planes in parallel")
+        workersFormLayout.addRow("Workers", self.workersSpinBox)
+
+        # lazy results are computed plane by plane when viewed and only written when saved
+        self.lazyCheckBox = QCheckBox("Lazy (compute on view)")
+        self.lazyCheckBox.setToolTip("Add results as chunked dask arrays instead of computing and saving them right away")
+        self.saveLazyButton = QPushButton("Save Selected")
+        self.saveLazyButton.setToolTip("Stream the selected layers to disk plane by plane")
+        self.saveLazyButton.clicked.connect(self.save_selected_layers)
+        workersFormLayout.addRow(self.lazyCheckBox, self.saveLazyButton)
+
+        # re-runs one operation on the plane on screen whenever a parameter or the plane changes
+        self.previewCheckBox = QCheckBox("Live preview")
+        self.previewCheckBox.setToolTip("Show the selected operation on the current plane in a reused preview layer")
+        self.previewDD = QComboBox()
+        self.previewDD.addItems(["Adaptive Threshold", "Normalization", "Contrast Limit", "Pipeline"])
+        workersFormLayout.addRow(self.previewCheckBox, self.previewDD)
+
         # Convert to Grayscale Section
         grayscaleGroupBox = QGroupBox()
         grayscaleGroupBox.setTitle("Convert to Grayscale")
@@ -74,7 +105,24 @@ class PreProcessingWidget(QWidget):
         self.normButton.setStyleSheet(TsegStyles.BTN_PRIMARY)
         self.normButton.clicked.connect(lambda: self.do_normalization(self.viewer))
 
+        # statistics of the whole stack (or of every timepoint) instead of every slice
+        self.globalStatsCheckBox = QCheckBox("Global statistics")
+        self.globalStatsCheckBox.setToolTip("Min-Max, Scale and Z-Score use one set of statistics per stack or timepoint")
+        self.statsScopeDD = QComboBox()
+        self.statsScopeDD.addItems(["Whole stack", "Per timepoint"])
+        globalLayout = QHBoxLayout()
+        globalLayout.addWidget(self.globalStatsCheckBox)
+        globalLayout.addWidget(self.statsScopeDD)
+
+        # 0 keeps min and max, otherwise clips to the [p, 100 - p] percentiles
+        self.clipPercentileSpinBox = QDoubleSpinBox()
+        self.clipPercentileSpinBox.setRange(0.0, 10.0)
+        self.clipPercentileSpinBox.setSingleStep(0.1)
+        self.clipPercentileSpinBox.setValue(0.0)
+
         normFormLayout.addRow("Normalization", normLayout)
+        normFormLayout.addRow(globalLayout)
+        normFormLayout.addRow("Clip Percentile", self.clipPercentileSpinBox)
         normFormLayout.addRow(self.normButton)
 
         layout.addWidget(QFrame(frameShape=QFrame.HLine))  # Add horizontal divider
@@ -107,10 +155,30 @@ class PreProcessingWidget(QWidget):
         self.logTrans = QPushButton("Log transform")
         self.logTrans.clicked.connect(lambda: self._log_transform_clicked())
 
+        # 1 thresholds every plane on its own, larger sizes also average over neighbouring planes
+        self.zRegionSpinBox = QSpinBox()
+        self.zRegionSpinBox.setRange(1, 31)
+        self.zRegionSpinBox.setSingleStep(2)
+        self.zRegionSpinBox.setValue(1)
+        self.nativeThreshCheckBox = QCheckBox("Native intensities")
+        self.nativeThreshCheckBox.setToolTip("Threshold the raw (e.g. 16-bit or float) values instead of every slice normalized to 8 bits; C is then in raw units")
+
         threshFormLayout.addRow(self.sub_region_lbl, self.sub_region)
         threshFormLayout.addRow(self.c_val_lbl, self.c_val_slider)
+        threshFormLayout.addRow("Z Neighbourhood", self.zRegionSpinBox)
+        threshFormLayout.addRow(self.nativeThreshCheckBox)
         threshFormLayout.addRow(self.adap)
 
+        # every (sub region, C) pair on the current plane, from one summed-area table per plane
+        self.sweepSubRegionsEdit = QLineEdit("5, 9, 15, 25, 41")
+        self.sweepCValuesEdit = QLineEdit("1, 3, 5, 10, 20")
+        self.sweepButton = QPushButton("Parameter Sweep")
+        self.sweepButton.setToolTip("Threshold the current plane for every combination of sub region and C value")
+        self.sweepButton.clicked.connect(self.do_threshold_sweep)
+        threshFormLayout.addRow("Sweep Sub Regions", self.sweepSubRegionsEdit)
+        threshFormLayout.addRow("Sweep C Values", self.sweepCValuesEdit)
+        threshFormLayout.addRow(self.sweepButton)
+
         self.adap.clicked.connect(lambda: self.do_adaptive_thresh(self.viewer))
 
         layout.addWidget(QFrame(frameShape=QFrame.HLine))  # Add horizontal divider
@@ -129,8 +197,43 @@ class PreProcessingWidget(QWidget):
 
         contrastFormLayout.addRow(self.contrastButton)
 
-        self.output_dir = Path.home() / ".tseg"
-        self.output_dir.mkdir(exist_ok=True)
+        layout.addWidget(QFrame(frameShape=QFrame.HLine))  # Add horizontal divider
+
+        # Pipeline Section
+        pipelineGroupBox = QGroupBox()
+        pipelineGroupBox.setTitle("Pipeline")
+        pipelineGroupBox.setStyleSheet("QGroupBox { font-size: 16pt; padding-top: 20px;}")
+        pipelineFormLayout = QFormLayout()
+        pipelineGroupBox.setLayout(pipelineFormLayout)
+        layout.addWidget(pipelineGroupBox)
+
+        # while recording, the buttons above append their operation instead of running it
+        self.pipeline = Pipeline()
+        self.recordCheckBox = QCheckBox("Record steps")
+        self.recordCheckBox.setToolTip("Buttons above add their operation to the pipeline instead of running it")
+        self.pipelineList = QListWidget()
+        self.pipelineList.setMaximumHeight(100)
+
+        self.runPipelineButton = QPushButton("Run Pipeline")
+        self.runPipelineButton.setStyleSheet(TsegStyles.BTN_PRIMARY)
+        self.runPipelineButton.clicked.connect(self.run_pipeline)
+        self.clearPipelineButton = QPushButton("Clear")
+        self.clearPipelineButton.clicked.connect(lambda: self._set_pipeline(Pipeline()))
+        self.savePipelineButton = QPushButton("Save")
+        self.savePipelineButton.clicked.connect(self.save_pipeline)
+        self.loadPipelineButton = QPushButton("Load")
+        self.loadPipelineButton.clicked.connect(self.load_pipeline)
+        pipelineButtonsLayout = QHBoxLayout()
+        pipelineButtonsLayout.addWidget(self.clearPipelineButton)
+        pipelineButtonsLayout.addWidget(self.savePipelineButton)
+        pipelineButtonsLayout.addWidget(self.loadPipelineButton)
+
+        pipelineFormLayout.addRow(self.recordCheckBox)
+        pipelineFormLayout.addRow(self.pipelineList)
+        pipelineFormLayout.addRow(pipelineButtonsLayout)
+        pipelineFormLayout.addRow(self.runPipelineButton)
+
+        self.output_dir = session_temp_dir()
 
         def _sub_region_changed(slider, label):
             value = slider.value()
@@ -151,6 +254,91 @@ class PreProcessingWidget(QWidget):
 
         self.c_val_slider.valueChanged.connect(lambda: _c_value_changed(self.c_val_slider, self.c_val_lbl))
 
+        # slider drags fire many events, the preview only runs once they pause
+        self._preview_source = None
+        self._preview_timer = QTimer(self)
+        self._preview_timer.setSingleShot(True)
+        self._preview_timer.setInterval(30)
+        self._preview_timer.timeout.connect(self.update_preview)
+        for signal in (
+            self.sub_region.valueChanged,
+            self.c_val_slider.valueChanged,
+            self.zRegionSpinBox.valueChanged,
+            self.gammaSpinBox.valueChanged,
+            self.normGroup.buttonClicked,
+            self.nativeThreshCheckBox.toggled,
+            self.globalStatsCheckBox.toggled,
+            self.statsScopeDD.currentIndexChanged,
+            self.clipPercentileSpinBox.valueChanged,
+            self.previewDD.currentIndexChanged,
+        ):
+            signal.connect(self._schedule_preview)
+        self.previewCheckBox.toggled.connect(self._preview_toggled)
+        self.viewer.dims.events.current_step.connect(self._schedule_preview)
+
+    def _preview_toggled(self, checked):
+        if self._preview_source is not None:
+            self._preview_source.events.contrast_limits.disconnect(self._schedule_preview)
+            self._preview_source = None
+        if checked:
+            # the layer selected when the preview is switched on is the one previewed
+            self._preview_source = self.viewer.layers.selection.active
+            if self._preview_source is not None:
+                # Contrast Limit previews the layer's own limits
+                self._preview_source.events.contrast_limits.connect(self._schedule_preview)
+            self._schedule_preview()
+        elif "preview" in self.viewer.layers:
+            self.viewer.layers.remove("preview")
+
+    def _schedule_preview(self, *args):
+        if self.previewCheckBox.isChecked():
+            self._preview_timer.start()
+
+    def _current_volume(self, layer):
+        """
+        Returns the 3D volume of ``layer`` on screen (a 2D layer as a single
+        plane volume) and the index of the displayed plane in it.
+        """
+        step = self.viewer.dims.current_step[-layer.ndim :]
+        data = layer.data
+        if data.ndim == 2:
+            return data[None], 0
+        return data[tuple(step[: data.ndim - 3])], step[data.ndim - 3]
+
+    def update_preview(self):
+        layer = self._preview_source
+        if layer is None or layer not in self.viewer.layers:
+            return
+        volume, z = self._current_volume(layer)
+        operation = self.previewDD.currentText()
+        if operation == "Adaptive Threshold":
+            # only the plane on screen and the z neighbours its neighbourhood needs are read
+            result = adaptive_threshold_plane(volume, z, self.sub_region.value() | 1, self.c_val_slider.value(), z_region=self.zRegionSpinBox.value() | 1, normalize=not self.nativeThreshCheckBox.isChecked())
+        else:
+            plane = np.asarray(volume[z])
+            method = self._global_method()
+            if operation == "Normalization" and method is not None:
+                # the plane on screen normalized as Apply does, with the statistics of its stack or timepoint
+                scope, percentiles, statistics = self._global_statistics()
+                step = self.viewer.dims.current_step[-layer.ndim :]
+                group = () if scope == "global" else tuple(step[: max(layer.ndim - 3, 0)])
+                result = global_normalization(plane, method, percentiles=percentiles, statistics={(): statistics(layer)[group]})
+            elif operation == "Normalization":
+                normalization, kwargs = self._normalization_operation()
+                result = normalization(plane, **kwargs)
+            elif operation == "Contrast Limit":
+                min_val, max_val = layer.contrast_limits
+                result = apply_contrast_limit(plane, min_val, max_val)
+            else:
+                result = self.pipeline(plane) if len(self.pipeline) else plane
+
+        # one reused 2D layer, shown on top of whichever plane is displayed
+        if "preview" in self.viewer.layers:
+            self.viewer.layers["preview"].data = result
+        else:
+            self.viewer.add_image(result, name="preview", blending="additive")
+        self.viewer.layers.selection.active = layer
+
     def _log_transform_clicked(self):
         layer = self.viewer.layers.selection.active
         img_data = layer.data
@@ -158,71 +346,219 @@ class PreProcessingWidget(QWidget):
         self.viewer.add_image(img2, name="log transform")
 
     def _save_image(self, image, original_name, suffix):
-        # Ensure the image is properly formatted for saving
-        if len(image.shape) == 3 and image.shape[0] not in [1, 3, 4]:
-            image = np.moveaxis(image, 0, -1)  # Move channels to the last dimension
+        # eager and lazy results are both written in the layer's own axis order
         output_path = self.output_dir / f"{original_name}_{suffix}.tif"
-        if len(image.shape) >= 3:
+        if not isinstance(image, np.ndarray):
+            # lazy result, computed and written one plane at a time
+            tifffile.imwrite(str(output_path), iter_planes(image), shape=image.shape, dtype=image.dtype, bigtiff=True)
+        elif len(image.shape) >= 3:
             tifffile.imwrite(str(output_path), image)
         else:
             cv2.imwrite(str(output_path), image)
         return output_path
 
-    def convert_to_grayscale(self, viewer):
-        selected_layers = [layer for layer in self.viewer.layers.selection]
-        for layer in selected_layers:
-            img_data = layer.data
-            img2 = preprocess_image(img_data, convert_to_grayscale)
-            new_layer_name = f"{layer.name}_grayscale"
-            output_path = self._save_image(img2, layer.name, "grayscale")
-            new_layer = self.viewer.add_image(img2, name=new_layer_name)
+    def _add_result(self, img2, layer, suffix, output_path=None):
+        new_layer = self.viewer.add_image(img2, name=f"{layer.name}_{suffix}")
+        new_layer.metadata["source"] = layer.name
+        new_layer.metadata["suffix"] = suffix
+        if output_path is not None:
             new_layer.metadata["path"] = str(output_path)
-        self.viewer.layers.selection.active = selected_layers[0] if selected_layers else None
+        return new_layer
+
+    def _run_on_selection(self, button, suffix, compute, metadata=None):
+        """
+        Computes ``compute(layer)`` for every selected layer in the background
+        and saves the eager results there too; the results are added as
+        layers once all of them are done.
+        """
+        selected_layers = [layer for layer in self.viewer.layers.selection]
+
+        def task():
+            results = []
+            for layer in selected_layers:
+                img2 = compute(layer)
+                output_path = self._save_image(img2, layer.name, suffix) if isinstance(img2, np.ndarray) else None
+                results.append((layer, img2, output_path))
+            return results
+
+        def on_done(results):
+            for layer, img2, output_path in results:
+                new_layer = self._add_result(img2, layer, suffix, output_path)
+                new_layer.metadata.update(metadata or {})
+            self.viewer.layers.selection.active = selected_layers[0] if selected_layers else None
+
+        self.tasks.run(button, task, on_done)
+
+    def _processor(self, operation, **kwargs):
+        """Returns ``process(img_data, **more_kwargs)`` applying ``operation`` plane by plane, lazily if requested."""
+        if self.lazyCheckBox.isChecked():
+            return lambda img_data, **more: lazy_preprocess_image(img_data, operation, **kwargs, **more)
+        workers = self.workersSpinBox.value()
+        return lambda img_data, **more: preprocess_image(img_data, operation, workers=workers, **kwargs, **more)
+
+    def _global_method(self):
+        """The ``global_normalization`` method of the checked normalization, None when it runs per plane."""
+        if not self.globalStatsCheckBox.isChecked():
+            return None
+        return GLOBAL_NORMALIZATIONS.get(self.normGroup.checkedButton().text())
+
+    def _global_statistics(self):
+        """Returns the scope, the clip percentiles and ``statistics(layer)`` of the global normalization."""
+        scope = "timepoint" if self.statsScopeDD.currentText() == "Per timepoint" else "global"
+        clip = self.clipPercentileSpinBox.value()
+        percentiles = (clip, 100 - clip) if clip > 0 else None
+        workers = self.workersSpinBox.value()
+
+        def statistics(layer):
+            # the statistics pass is cached per layer, repeated normalizations only transform
+            cache = layer.metadata.setdefault("statistics", {})
+            key = (scope, percentiles is not None)
+            if key not in cache:
+                cache[key] = image_statistics(layer.data, scope, histogram=percentiles is not None, workers=workers)
+            return cache[key]
+
+        return scope, percentiles, statistics
+
+    def _global_normalization(self, method):
+        """Returns ``compute(layer)`` normalizing with the stack or timepoint statistics."""
+        scope, percentiles, statistics = self._global_statistics()
+        workers, lazy = self.workersSpinBox.value(), self.lazyCheckBox.isChecked()
+
+        def compute(layer):
+            return global_normalization(layer.data, method, scope, percentiles, statistics=statistics(layer), workers=workers, lazy=lazy)
+
+        return compute
+
+    def save_selected_layers(self):
+        layers = [layer for layer in self.viewer.layers.selection if not layer.metadata.get("path")]
+
+        def task():
+            return [(layer, self._save_image(layer.data, layer.metadata.get("source", layer.name), layer.metadata.get("suffix", "saved"))) for layer in layers]
+
+        def on_done(saved):
+            for layer, output_path in saved:
+                layer.metadata["path"] = str(output_path)
+                print(f"Saved {layer.name} to {output_path}")
+
+        self.tasks.run(self.saveLazyButton, task, on_done)
+
+    def _record(self, operation, **params):
+        """Appends the operation to the pipeline when recording; returns whether it did."""
+        if not self.recordCheckBox.isChecked():
+            return False
+        self.pipeline.add(operation.__name__, **params)
+        self._set_pipeline(self.pipeline)
+        return True
+
+    def _set_pipeline(self, pipeline):
+        self.pipeline = pipeline
+        self.pipelineList.clear()
+        for name, params in pipeline.steps:
+            self.pipelineList.addItem(f"{name}({', '.join(f'{key}={value}' for key, value in params.items())})")
+
+    def run_pipeline(self):
+        if not len(self.pipeline):
+            print("The pipeline is empty!")
+            return
+        # every plane goes through all steps at once, only the final result is added and saved
+        pipeline, workers, lazy = Pipeline.from_dict(self.pipeline.to_dict()), self.workersSpinBox.value(), self.lazyCheckBox.isChecked()
+        self._run_on_selection(self.runPipelineButton, "pipeline", lambda layer: pipeline.run(layer.data, workers=workers, lazy=lazy), {"pipeline": pipeline.to_dict()})
+
+    def save_pipeline(self):
+        path, _ = QFileDialog.getSaveFileName(self, "Save Pipeline", str(self.output_dir / "pipeline.json"), "JSON (*.json)")
+        if path:
+            self.pipeline.save(path)
+
+    def load_pipeline(self):
+        path, _ = QFileDialog.getOpenFileName(self, "Load Pipeline", str(self.output_dir), "JSON (*.json)")
+        if path:
+            self._set_pipeline(Pipeline.load(path))
+
+    def convert_to_grayscale(self, viewer):
+        if self._record(convert_to_grayscale):
+            return
+        process = self._processor(convert_to_grayscale)
+        self._run_on_selection(self.grayscaleButton, "grayscale", lambda layer: process(layer.data))
 
     def do_adaptive_thresh(self, viewer):
-        selected_layers = [layer for layer in self.viewer.layers.selection]
-        for layer in selected_layers:
-            img_data = layer.data
-            img2 = preprocess_image(img_data, adaptive_thresh, sub_region=self.sub_region.value(), c_value=self.c_val_slider.value())
-            new_layer_name = f"{layer.name}_AdaptiveThresh"
-            output_path = self._save_image(img2, layer.name, "AdaptiveThresh")
-            new_layer = self.viewer.add_image(img2, name=new_layer_name)
-            new_layer.metadata["path"] = str(output_path)
-        self.viewer.layers.selection.active = selected_layers[0] if selected_layers else None
+        z_region = self.zRegionSpinBox.value() | 1
+        kwargs = dict(sub_region=self.sub_region.value(), c_value=self.c_val_slider.value(), normalize=not self.nativeThreshCheckBox.isChecked())
+        if z_region > 1 and self.recordCheckBox.isChecked():
+            print("A z neighbourhood spans planes, so it is not a plane operation and cannot be recorded!")
+            return
+        if self._record(adaptive_threshold, **kwargs):
+            return
+        if self.lazyCheckBox.isChecked() and z_region == 1:
+            compute = lambda layer: lazy_preprocess_image(layer.data, adaptive_threshold, workers=1, **kwargs)
+        else:
+            # a z neighbourhood spans planes, so it is computed eagerly on whole volumes
+            workers = self.workersSpinBox.value()
+            compute = lambda layer: adaptive_threshold(layer.data, z_region=z_region, workers=workers, **kwargs)
+        self._run_on_selection(self.adap, "AdaptiveThresh", compute)
 
-    def do_normalization(self, viewer):
-        selected_layers = [layer for layer in self.viewer.layers.selection]
+    def do_threshold_sweep(self):
+        layer = self.viewer.layers.selection.active
+        if layer is None:
+            print("No layer selected!")
+            return
+        try:
+            sub_regions = sorted({int(value) | 1 for value in self.sweepSubRegionsEdit.text().split(",") if value.strip()})
+            c_values = [float(value) for value in self.sweepCValuesEdit.text().split(",") if value.strip()]
+        except ValueError:
+            print("Sweep values have to be comma separated numbers!")
+            return
+        if not sub_regions or not c_values:
+            return
+
+        # the plane on screen, with the z neighbours a volumetric neighbourhood needs
+        z_region = self.zRegionSpinBox.value() | 1
+        volume, z = self._current_volume(layer)
+        # replicating the border planes here is what adaptive_threshold does at the volume's ends
+        index = np.clip(np.arange(z - z_region // 2, z + z_region // 2 + 1), 0, volume.shape[0] - 1)
+        gallery = adaptive_threshold_sweep(np.asarray(volume[index]), sub_regions, c_values, z_region=z_region, normalize=not self.nativeThreshCheckBox.isChecked())
+        gallery = gallery[:, :, z_region // 2]
+        sweep_layer = self.viewer.add_image(gallery, name=f"{layer.name}_sweep")
+        # first slider: sub region, second slider: C value
+        sweep_layer.metadata["sub_regions"] = sub_regions
+        sweep_layer.metadata["c_values"] = c_values
+        print(f"Sweep axes: sub regions {sub_regions} x C values {c_values}")
+
+    def _normalization_operation(self):
         norm_type = self.normGroup.checkedButton().text()
-        for layer in selected_layers:
-            img_data = layer.data
-            if norm_type == "Min-Max":
-                img2 = preprocess_image(img_data, min_max_normalization)
-            elif norm_type == "Scale to -1,+1":
-                img2 = preprocess_image(img_data, scale_to_minus1_plus1)
-            elif norm_type == "Z-Score":
-                img2 = preprocess_image(img_data, z_score_normalization)
-            elif norm_type == "Hist Eq":
-                img2 = preprocess_image(img_data, histogram_equalization)
-            elif norm_type == "Gamma Correction":
-                img2 = preprocess_image(img_data, gamma_correction, gamma=self.gammaSpinBox.value())
-            new_layer_name = f"{layer.name}_normalized"
-            output_path = self._save_image(img2, layer.name, "normalized")
-            new_layer = self.viewer.add_image(img2, name=new_layer_name)
-            new_layer.metadata["path"] = str(output_path)
-        self.viewer.layers.selection.active = selected_layers[0] if selected_layers else None
+        if norm_type == "Min-Max":
+            return min_max_normalization, {}
+        elif norm_type == "Scale to -1,+1":
+            return scale_to_minus1_plus1, {}
+        elif norm_type == "Z-Score":
+            return z_score_normalization, {}
+        elif norm_type == "Hist Eq":
+            return histogram_equalization, {}
+        elif norm_type == "Gamma Correction":
+            return gamma_correction, {"gamma": self.gammaSpinBox.value()}
+
+    def do_normalization(self, viewer):
+        method = self._global_method()
+        operation, kwargs = self._normalization_operation()
+        if method is not None and self.recordCheckBox.isChecked():
+            print("Global statistics normalization is not a plane operation and cannot be recorded!")
+            return
+        if self._record(operation, **kwargs):
+            return
+        if method is not None:
+            compute = self._global_normalization(method)
+        else:
+            process = self._processor(operation, **kwargs)
+            compute = lambda layer: process(layer.data)
+        self._run_on_selection(self.normButton, "normalized", compute)
 
     def apply_contrast_limit(self, viewer):
         selected_layers = [layer for layer in self.viewer.layers.selection]
-        for layer in selected_layers:
-            img_data = layer.data
-            # Retrieve contrast limits from the layer controls panel
-            min_val, max_val = layer.contrast_limits
-            img2 = preprocess_image(img_data, apply_contrast_limit, min_val=min_val, max_val=max_val)
-            new_layer_name = f"{layer.name}_contrast"
-            output_path = self._save_image(img2, layer.name, "contrast")
-            new_layer = self.viewer.add_image(img2, name=new_layer_name)
-            new_layer.metadata["path"] = str(output_path)
-        self.viewer.layers.selection.active = selected_layers[0] if selected_layers else None
+        if selected_layers and self._record(apply_contrast_limit, min_val=float(selected_layers[0].contrast_limits[0]), max_val=float(selected_layers[0].contrast_limits[1])):
+            return
+        # Retrieve contrast limits from the layer controls panel
+        contrast_limits = {layer.name: tuple(layer.contrast_limits) for layer in selected_layers}
+        process = self._processor(apply_contrast_limit)
+        self._run_on_selection(self.contrastButton, "contrast", lambda layer: process(layer.data, min_val=contrast_limits[layer.name][0], max_val=contrast_limits[layer.name][1]))
 
     def _enable_disable(self):
         if self.enablePrep.isChecked():
@@ -1,6 +1,11 @@
+import json
+from functools import partial
+
 import cv2
 import numpy as np
 
+from tseg.core.parallel import checkpoint, map_frames
+
 def detect_data_format(image):
     shape = image.shape
     if len(shape) == 2:
@@ -20,49 +25,474 @@ def detect_data_format(image):
     else:
         raise ValueError("Unsupported image format")
 
-def preprocess_image(image, operation, **kwargs):
+def _apply_plane(plane, image, out, index, operation, kwargs):
+    out[index] = operation(image[index], **kwargs)
+
+
+def preprocess_image(image, operation, workers=None, out=None, **kwargs):
+    """
+    Applies a 2D ``operation`` to every plane (the last two axes) of an image
+    in any of the layouts of ``detect_data_format``. The results are written
+    into one preallocated array, and planes run concurrently on ``workers``
+    threads (OpenCV releases the GIL); ``None`` uses every core. ``out`` can
+    be a preallocated output array, e.g. a memory map.
+    """
     data_format = detect_data_format(image)
-    
     if data_format == "2D":
-        return operation(image, **kwargs)
-    elif data_format == "2D with channels":
-        channels = [operation(image[c], **kwargs) for c in range(image.shape[0])]
-        return np.stack(channels, axis=0)
-    elif data_format == "3D":
-        slices = [operation(image[z], **kwargs) for z in range(image.shape[0])]
-        return np.stack(slices, axis=0)
-    elif data_format == "3D with channels":
-        channels = []
-        for c in range(image.shape[0]):
-            slices = [operation(image[c, z], **kwargs) for z in range(image.shape[1])]
-            channels.append(np.stack(slices, axis=0))
-        return np.stack(channels, axis=0)
-    elif data_format == "4D":
-        timepoints = []
-        for t in range(image.shape[0]):
-            slices = [operation(image[t, z], **kwargs) for z in range(image.shape[1])]
-            timepoints.append(np.stack(slices, axis=0))
-        return np.stack(timepoints, axis=0)
-    elif data_format == "4D with channels":
-        channels = []
-        for c in range(image.shape[0]):
-            timepoints = []
-            for t in range(image.shape[1]):
-                slices = [operation(image[c, t, z], **kwargs) for z in range(image.shape[2])]
-                timepoints.append(np.stack(slices, axis=0))
-            channels.append(np.stack(timepoints, axis=0))
-        return np.stack(channels, axis=0)
-    else:
-        raise ValueError("Unsupported image format")
+        if out is None:
+            return operation(image, **kwargs)
+        out[...] = operation(image, **kwargs)
+        return out
+
+    # the first plane fixes the output shape and dtype
+    index = list(np.ndindex(image.shape[:-2]))
+    first = operation(image[index[0]], **kwargs)
+    if out is None:
+        out = np.empty(image.shape[:-2] + first.shape, dtype=first.dtype)
+    out[index[0]] = first
+    map_frames(
+        partial(_apply_plane, operation=operation, kwargs=kwargs),
+        (image, out),
+        len(index) - 1,
+        workers=workers,
+        backend="thread",
+        desc=getattr(operation, "__name__", None),
+        frame_args=index[1:],
+    )
+    return out
+
+def _apply_block(block, operation, kwargs, lead):
+    return operation(block[(0,) * lead], **kwargs)[(None,) * lead]
+
+
+def lazy_preprocess_image(image, operation, **kwargs):
+    """
+    Lazy counterpart of ``preprocess_image``: returns a dask array with one
+    chunk per 2D plane, so a plane is only computed when it is viewed or
+    saved. ``image`` can be a numpy array, a memory map or a dask array;
+    ``operation`` has to map a 2D plane to a 2D plane.
+    """
+    import dask.array as da
+
+    lead = 0 if detect_data_format(image) == "2D" else image.ndim - 2
+    chunks = (1,) * lead + tuple(image.shape[lead:])
+    # name=False skips hashing the whole input to name the graph
+    source = image.rechunk(chunks) if isinstance(image, da.Array) else da.from_array(image, chunks=chunks, name=False)
+    # the first plane fixes the output plane shape and dtype
+    first = operation(np.asarray(image[(0,) * lead]), **kwargs)
+    return source.map_blocks(
+        _apply_block,
+        operation=operation,
+        kwargs=kwargs,
+        lead=lead,
+        dtype=first.dtype,
+        chunks=(1,) * lead + first.shape,
+        meta=np.empty((0,) * (lead + first.ndim), dtype=first.dtype),
+    )
+
+
+def iter_planes(image):
+    """
+    Yields the 2D planes of a (possibly lazy) image in C order, computing
+    one plane at a time whatever the number of leading axes, so a lazy
+    result can be streamed to disk without being held in memory.
+    """
+    if image.ndim <= 2:
+        yield np.asarray(image)
+        return
+    leading = image.shape[:-2]
+    total = int(np.prod(leading))
+    for done, index in enumerate(np.ndindex(*leading), 1):
+        yield np.asarray(image[index])
+        checkpoint("writing", done, total)
+
+
+class ImageStatistics:
+    """
+    Streaming intensity statistics of a set of planes: count, mean and
+    variance (Welford / Chan et al. merge), min, max and optionally a
+    histogram for percentiles. The histogram is exact (one bin per value)
+    for integer images of up to 16 bits; other dtypes get ``bins`` bins
+    between min and max, filled by ``image_statistics`` in an extra pass.
+    """
+
+    def __init__(self, histogram=False, bins=4096):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+        self.histogram = np.zeros(0, dtype=np.int64) if histogram else None
+        self.bin_edges = None
+        self.bins = bins
+
+    @property
+    def var(self):
+        return self.m2 / self.count if self.count else np.nan
+
+    @property
+    def std(self):
+        return np.sqrt(self.var)
+
+    def merge(self, count, mean, m2, vmin, vmax, histogram=None):
+        """Adds the statistics of another set of values."""
+        if count:
+            total = self.count + count
+            delta = mean - self.mean
+            self.mean += delta * count / total
+            self.m2 += m2 + delta**2 * self.count * count / total
+            self.count = total
+            self.min = min(self.min, vmin)
+            self.max = max(self.max, vmax)
+        if histogram is not None and self.histogram is not None:
+            if len(histogram) > len(self.histogram):
+                self.histogram, histogram = histogram.copy(), self.histogram
+            self.histogram[: len(histogram)] += histogram
+
+    def percentile(self, q):
+        """Value below which ``q`` percent of the values lie, from the histogram."""
+        if self.histogram is None:
+            raise ValueError("Percentiles need statistics computed with a histogram.")
+        cdf = np.cumsum(self.histogram)
+        position = min(np.searchsorted(cdf, q / 100 * cdf[-1]), len(cdf) - 1)
+        if self.bin_edges is None:
+            # exact histograms start at the minimum
+            return float(self.min + position)
+        return float(self.bin_edges[position + 1])
+
+
+def _exact_histogram(dtype):
+    return np.dtype(dtype).kind in "ui" and np.dtype(dtype).itemsize <= 2
+
+
+def _plane_statistics(plane, image, index, histogram):
+    values = np.asarray(image[index])
+    mean = values.mean(dtype=np.float64)
+    m2 = np.square(values - mean, dtype=np.float64).sum()
+    counts = None
+    if histogram:
+        # offset by the dtype minimum so signed images index from 0
+        counts = np.bincount((values.ravel().astype(np.int64) - np.iinfo(values.dtype).min))
+    return values.size, mean, m2, values.min(), values.max(), counts
+
+
+def _statistics_groups(image, scope):
+    """Plane indices and, for every plane, the key of its statistics group."""
+    index = list(np.ndindex(image.shape[:-2])) or [()]
+    if scope == "global":
+        return index, [()] * len(index)
+    if scope == "timepoint":
+        # one group per 3D volume, i.e. per index of the axes before z
+        return index, [i[: max(image.ndim - 3, 0)] for i in index]
+    raise ValueError(f'Unknown statistics scope "{scope}", expected "global" or "timepoint".')
+
+
+def image_statistics(image, scope="global", histogram=False, bins=4096, workers=None):
+    """
+    Computes ``ImageStatistics`` of an image in one streaming pass over its
+    2D planes, on ``workers`` threads.
+    Parameters
+    ----------
+    scope : {"global", "timepoint"}
+        "global" gathers the whole image, "timepoint" every 3D volume
+        (every index of the axes before z) separately.
+    histogram : bool
+        Also gathers a histogram for ``ImageStatistics.percentile``.
+    Returns
+    -------
+    statistics : dict
+        ``{group index: ImageStatistics}``, the only key being ``()`` for
+        the "global" scope.
+    """
+    index, groups = _statistics_groups(image, scope)
+    exact = histogram and _exact_histogram(image.dtype)
+    statistics = {group: ImageStatistics(histogram, bins) for group in dict.fromkeys(groups)}
+
+    def merge(plane, result):
+        statistics[groups[plane]].merge(*result)
+
+    map_frames(partial(_plane_statistics, histogram=exact), (image,), len(index), workers=workers, backend="thread", desc="statistics", frame_args=index, callback=merge)
+    if exact:
+        # exact histograms are indexed from the dtype minimum, drop the empty head
+        for stats in statistics.values():
+            stats.histogram = stats.histogram[int(stats.min) - np.iinfo(image.dtype).min :]
+
+    if histogram and not exact:
+        # floating point images: bins between the now known min and max
+        for stats in statistics.values():
+            stats.bin_edges = np.linspace(stats.min, stats.max, bins + 1)
+            stats.histogram = np.zeros(bins, dtype=np.int64)
+
+        def add_bins(plane, counts):
+            statistics[groups[plane]].histogram += counts
+
+        def plane_histogram(plane, image, index):
+            return np.histogram(np.asarray(image[index]), bins=statistics[groups[plane]].bin_edges)[0]
+
+        map_frames(
+            plane_histogram,
+            (image,),
+            len(index),
+            workers=workers,
+            backend="thread",
+            desc="histogram",
+            frame_args=index,
+            callback=add_bins,
+        )
+    return statistics
+
+
+def _normalize_plane(image, method, low, high, mean, std):
+    plane = np.clip(image.astype(np.float32), low, high)
+    if method == "minmax":
+        return np.rint((plane - low) * (255 / (high - low) if high > low else 0)).astype(np.uint8)
+    if method == "scale":
+        return (plane - low) * (2 / (high - low) if high > low else 0) - 1
+    # like z_score_normalization, the z-scores are stretched to 0..255, over the clip range's z-scores
+    std = std if std > 0 else 1
+    z_low, z_high = (low - mean) / std, (high - mean) / std
+    return np.rint(((plane - mean) / std - z_low) * (255 / (z_high - z_low) if high > low else 0)).astype(np.uint8)
+
+
+def global_normalization(image, method="minmax", scope="global", percentiles=None, statistics=None, workers=None, lazy=False):
+    """
+    Normalizes an image with statistics of the whole image (or of every 3D
+    volume) instead of every 2D plane on its own, so that there are no
+    intensity jumps between planes.
+    Parameters
+    ----------
+    method : {"minmax", "scale", "zscore"}
+        "minmax" maps to 0..255 (uint8), "scale" to -1..+1 (float32) and
+        "zscore" to z-scores stretched to 0..255 (uint8), the output of the
+        per-slice ``z_score_normalization``.
+    scope : {"global", "timepoint"}
+        See ``image_statistics``.
+    percentiles : tuple, optional
+        ``(low, high)`` percentiles the intensities are clipped to before
+        normalizing, instead of min and max.
+    statistics : dict, optional
+        Result of ``image_statistics`` for the same image and scope, to
+        skip the statistics pass (e.g. cached in a layer's metadata).
+    lazy : bool
+        Returns a lazy dask array (see ``lazy_preprocess_image``).
+    """
+    if method not in ("minmax", "scale", "zscore"):
+        raise ValueError(f'Unknown normalization "{method}", expected "minmax", "scale" or "zscore".')
+    if statistics is None:
+        statistics = image_statistics(image, scope, histogram=percentiles is not None, workers=workers)
+
+    out, parts = None, []
+    for group, stats in statistics.items():
+        low, high = (stats.min, stats.max) if percentiles is None else (stats.percentile(percentiles[0]), stats.percentile(percentiles[1]))
+        operation = partial(_normalize_plane, method=method, low=low, high=high, mean=stats.mean, std=stats.std)
+        if lazy:
+            parts.append(lazy_preprocess_image(image[group], operation))
+            continue
+        if out is None:
+            out = np.empty(image.shape, dtype=np.float32 if method == "scale" else np.uint8)
+        preprocess_image(image[group], operation, workers=workers, out=out[group])
+    if lazy:
+        import dask.array as da
+
+        return parts[0] if len(parts) == 1 and parts[0].shape == image.shape else da.stack(parts).reshape(image.shape)
+    return out
+
+
+def to_uint8(image):
+    """
+    ``cv2.normalize(image, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)``,
+    the conversion most operations start with. It is skipped for uint8
+    images that already span 0..255 (e.g. the output of a previous step),
+    for which it is the identity.
+    """
+    if image.dtype == np.uint8 and image.min() == 0 and image.max() == 255:
+        return image
+    return cv2.normalize(image, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
+
 
 def adaptive_thresh(img, sub_region, c_value):
     print("subregion:", sub_region, "c_val", c_value)
     # Convert image to 8-bit single-channel
-    img = cv2.normalize(img, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
+    img = to_uint8(img)
     thresh = cv2.adaptiveThreshold(img, 255,
                                    cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY_INV, sub_region, c_value)
     return thresh
 
+def _to_uint8(planes):
+    """The per-plane uint8 conversion of ``adaptive_thresh``."""
+    return np.stack([to_uint8(plane) for plane in planes])
+
+
+def _integral_tables(planes, radius):
+    """
+    Summed-area tables (``cv2.integral``) of every plane, padded by
+    ``radius`` replicated pixels, so that they serve every box up to
+    ``2 * radius + 1`` pixels wide.
+    """
+    exact = planes.dtype == np.uint8
+    if planes.dtype not in (np.uint8, np.uint16, np.int16, np.float32, np.float64):
+        planes = planes.astype(np.float64)
+    return np.stack([cv2.integral(cv2.copyMakeBorder(plane, radius, radius, radius, radius, cv2.BORDER_REPLICATE), sdepth=cv2.CV_32S if exact else cv2.CV_64F) for plane in planes])
+
+
+def _box_sums(tables, radius, size):
+    """
+    Sums over ``size`` x ``size`` neighbourhoods of every plane from
+    ``_integral_tables(planes, radius)``. Replicated borders are the same
+    for any padding wider than the box, so one table serves every size.
+    """
+    height, width = tables.shape[1] - 1 - 2 * radius, tables.shape[2] - 1 - 2 * radius
+    a, b = radius - size // 2, radius + size // 2 + 1
+    return tables[:, b : b + height, b : b + width] - tables[:, a : a + height, b : b + width] - tables[:, b : b + height, a : a + width] + tables[:, a : a + height, a : a + width]
+
+
+def _running_sum(values, width):
+    """Sums over ``width`` consecutive items of the first axis (``len(values) - width + 1`` of them)."""
+    if width == 1:
+        return values
+    if width <= 8:
+        # a few shifted additions beat a wide cumulative sum
+        length = len(values) - width + 1
+        total = values[:length].copy()
+        for offset in range(1, width):
+            total += values[offset : offset + length]
+        return total
+    running = np.cumsum(values, axis=0, dtype=np.int64 if values.dtype.kind in "iu" else np.float64)
+    return np.concatenate([running[width - 1 : width], running[width:] - running[:-width]])
+
+
+def _mean_offsets(src, sums, n, normalize):
+    """
+    ``src`` minus its local mean ``sums / n``; a voxel is thresholded where
+    this is at most ``-C``, so one offset image serves every C value.
+    """
+    if normalize:
+        # cv2.adaptiveThreshold (MEAN_C) rounds the uint8 mean to nearest; the mean of an odd
+        # number of integers is never halfway, so the integer rounding below is exact
+        return src.astype(np.int16) - ((2 * sums.astype(np.int64) + n) // (2 * n)).astype(np.int16)
+    return src - sums * (1.0 / n)
+
+
+def _threshold_offsets(offsets, c_value, normalize, out):
+    # THRESH_BINARY_INV: 255 where src - mean <= -C, OpenCV flooring C for uint8 images
+    np.multiply(offsets <= -(np.floor(c_value) if normalize else c_value), 255, out=out, dtype=np.uint8)
+
+
+def _threshold_chunk(chunk, volumes, out, bounds, sub_region, c_value, z_region, normalize):
+    v, z0, z1 = bounds
+    rz = z_region // 2
+    # clipping the z indices replicates the first and last planes, like the borders in y and x
+    planes = volumes[v, np.clip(np.arange(z0 - rz, z1 + rz), 0, volumes.shape[1] - 1)]
+    if normalize:
+        planes = _to_uint8(planes)
+        if z_region == 1:
+            # in-plane neighbourhoods of uint8 planes are exactly what OpenCV implements
+            for i, plane in enumerate(planes):
+                out[v, z0 + i] = cv2.adaptiveThreshold(plane, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY_INV, sub_region, c_value)
+            return
+    sums = _running_sum(_box_sums(_integral_tables(planes, sub_region // 2), sub_region // 2, sub_region), z_region)
+    offsets = _mean_offsets(planes[rz : rz + z1 - z0], sums, z_region * sub_region * sub_region, normalize)
+    _threshold_offsets(offsets, c_value, normalize, out[v, z0:z1])
+
+
+def adaptive_threshold(image, sub_region, c_value, z_region=1, normalize=True, workers=None, out=None, chunk_planes=16):
+    """
+    Adaptive mean threshold (inverted binary, 255 where a voxel is at least
+    ``c_value`` below its local mean) of whole 2D-5D arrays, with local means
+    from summed-area tables instead of one OpenCV call per plane.
+    Parameters
+    ----------
+    sub_region : integer
+        Odd size of the neighbourhood in y and x.
+    c_value : number
+        Offset subtracted from the local mean.
+    z_region : integer
+        Odd size of the neighbourhood along z (the third to last axis); 1
+        thresholds every plane on its own and then matches
+        ``adaptive_thresh`` exactly.
+    normalize : bool
+        Min-max normalizes every plane to uint8 first, as ``adaptive_thresh``
+        does. ``False`` thresholds the native (e.g. 16-bit or float)
+        intensities, ``c_value`` being in their units.
+    workers : integer, optional
+        Number of threads, ``None`` uses every core.
+    out : array, optional
+        Preallocated uint8 output, e.g. a memory map.
+    chunk_planes : integer
+        Number of planes processed at once per thread.
+    Returns
+    -------
+    thresh : array of uint8
+        0 / 255 mask with the shape of ``image``.
+    """
+    if sub_region % 2 == 0 or z_region % 2 == 0:
+        raise ValueError(f"sub_region and z_region have to be odd, got {sub_region} and {z_region}.")
+    if image.ndim == 2 and z_region == 1 and out is None:
+        # a single plane, e.g. inside a Pipeline
+        out = np.empty(image.shape, dtype=np.uint8)
+        _threshold_chunk(0, image[None, None], out[None, None], (0, 0, 1), sub_region, c_value, z_region, normalize)
+        return out
+    shape = image.shape
+    volumes = image.reshape((-1,) + ((1,) if image.ndim == 2 else shape[-3:-2]) + shape[-2:])
+    if out is None:
+        out = np.empty(shape, dtype=np.uint8)
+    n_planes = volumes.shape[1]
+    chunks = [(v, z0, min(z0 + chunk_planes, n_planes)) for v in range(volumes.shape[0]) for z0 in range(0, n_planes, chunk_planes)]
+    map_frames(
+        partial(_threshold_chunk, sub_region=sub_region, c_value=c_value, z_region=z_region, normalize=normalize),
+        (volumes, out.reshape(volumes.shape)),
+        len(chunks),
+        workers=workers,
+        backend="thread",
+        desc="adaptive threshold",
+        frame_args=chunks,
+    )
+    return out
+
+
+def adaptive_threshold_plane(volume, z, sub_region, c_value, z_region=1, normalize=True):
+    """
+    ``adaptive_threshold(volume, ...)[z]`` of a 3D ``volume``, reading only
+    plane ``z`` and its ``z_region // 2`` neighbours on either side, e.g.
+    for a live preview of the plane on screen.
+    """
+    rz = z_region // 2
+    # only the planes the neighbourhood needs, with the borders replicated
+    index = np.clip(np.arange(z - rz, z + rz + 1), 0, volume.shape[0] - 1)
+    out = np.empty((1, len(index)) + volume.shape[-2:], dtype=np.uint8)
+    _threshold_chunk(0, np.asarray(volume[index])[None], out, (0, rz, rz + 1), sub_region, c_value, z_region, normalize)
+    return out[0, rz]
+
+
+def adaptive_threshold_sweep(image, sub_regions, c_values, z_region=1, normalize=True):
+    """
+    ``adaptive_threshold`` of a plane (or a small z-stack) for every
+    combination of ``sub_regions`` and ``c_values``. One summed-area table
+    per plane serves every sub-region size, and every C value is only a
+    comparison against the same local means.
+    Returns
+    -------
+    gallery : array of uint8, shape (len(sub_regions), len(c_values)) + image.shape
+        ``gallery[i, j]`` is the threshold with ``sub_regions[i]`` and
+        ``c_values[j]``.
+    """
+    if any(size % 2 == 0 for size in sub_regions) or z_region % 2 == 0:
+        raise ValueError(f"Sub-region sizes and z_region have to be odd, got {list(sub_regions)} and {z_region}.")
+    planes = image[None] if image.ndim == 2 else image
+    if normalize:
+        planes = _to_uint8(planes)
+    rz, radius = z_region // 2, max(sub_regions) // 2
+    padded = planes[np.clip(np.arange(-rz, len(planes) + rz), 0, len(planes) - 1)]
+    tables = _integral_tables(padded, radius)
+
+    gallery = np.empty((len(sub_regions), len(c_values)) + planes.shape, dtype=np.uint8)
+    for i, size in enumerate(sub_regions):
+        offsets = _mean_offsets(planes, _running_sum(_box_sums(tables, radius, size), z_region), z_region * size * size, normalize)
+        for j, c_value in enumerate(c_values):
+            _threshold_offsets(offsets, c_value, normalize, gallery[i, j])
+    return gallery.reshape(gallery.shape[:2] + image.shape)
+
+
 def log_transformation(image):
     # Apply log transformation method
     c = 255 / np.log(1 + np.max(image))
@@ -74,8 +504,7 @@ def log_transformation(image):
     return log_image
 
 def min_max_normalization(image):
-    norm_image = cv2.normalize(image, None, 0, 255, cv2.NORM_MINMAX)
-    return norm_image.astype(np.uint8)
+    return to_uint8(image)
 
 def scale_to_minus1_plus1(image):
     norm_image = cv2.normalize(image, None, -1, 1, cv2.NORM_MINMAX)
@@ -89,7 +518,7 @@ def z_score_normalization(image):
 
 def histogram_equalization(image):
     # Convert image to 8-bit single-channel
-    image = cv2.normalize(image, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
+    image = to_uint8(image)
     if len(image.shape) == 2:  # Grayscale image
         norm_image = cv2.equalizeHist(image)
     else:  # Color image
@@ -100,7 +529,7 @@ def histogram_equalization(image):
 
 def gamma_correction(image, gamma=1.0):
     # Convert image to 8-bit single-channel
-    image = cv2.normalize(image, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
+    image = to_uint8(image)
     inv_gamma = 1.0 / gamma
     table = np.array([((i / 255.0) ** inv_gamma) * 255 for i in np.arange(0, 256)]).astype("uint8")
     norm_image = cv2.LUT(image, table)
@@ -121,3 +550,77 @@ def apply_contrast_limit(image, min_val, max_val):
     image = np.clip(image, min_val, max_val)
     norm_image = cv2.normalize(image, None, 0, 255, cv2.NORM_MINMAX)
     return norm_image.astype(np.uint8)
+
+
+# Plane operations a Pipeline can record, by name
+OPERATIONS = {
+    operation.__name__: operation
+    for operation in (
+        convert_to_grayscale,
+        min_max_normalization,
+        scale_to_minus1_plus1,
+        z_score_normalization,
+        histogram_equalization,
+        gamma_correction,
+        apply_contrast_limit,
+        log_transformation,
+        adaptive_thresh,
+        adaptive_threshold,
+    )
+}
+
+
+class Pipeline:
+    """
+    Ordered list of plane operations (``OPERATIONS``) with their parameters,
+    applied fused: every plane goes through all steps before the next one
+    is read, so only the final result is ever allocated. A pipeline is a
+    plane operation itself, and it can be saved to and loaded from JSON to
+    replay it on other datasets.
+    """
+
+    def __init__(self, steps=None):
+        self.steps = []
+        for name, params in steps or []:
+            self.add(name, **params)
+
+    def add(self, name, **params):
+        """Appends the operation ``name`` with ``params``; returns the pipeline."""
+        if name not in OPERATIONS:
+            raise ValueError(f'Unknown operation "{name}", expected one of {sorted(OPERATIONS)}.')
+        # plain python numbers, so the steps can be written as JSON
+        self.steps.append((name, {key: value.item() if isinstance(value, np.generic) else value for key, value in params.items()}))
+        return self
+
+    def __len__(self):
+        return len(self.steps)
+
+    def __call__(self, plane):
+        for name, params in self.steps:
+            plane = OPERATIONS[name](plane, **params)
+        return plane
+
+    def run(self, image, workers=None, out=None, lazy=False):
+        """
+        Applies the pipeline to every plane of ``image`` in one pass (see
+        ``preprocess_image``), or lazily (see ``lazy_preprocess_image``).
+        """
+        if lazy:
+            return lazy_preprocess_image(image, self)
+        return preprocess_image(image, self, workers=workers, out=out)
+
+    def to_dict(self):
+        return {"steps": [{"operation": name, "params": params} for name, params in self.steps]}
+
+    @classmethod
+    def from_dict(cls, record):
+        return cls([(step["operation"], step.get("params", {})) for step in record["steps"]])
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls.from_dict(json.load(f))
@@ -0,0 +1,80 @@
+import threading
+import traceback
+
+from qtpy.QtCore import QObject, Signal
+from napari.qt.threading import create_worker
+from tseg.core.parallel import Cancelled, task_context
+
+
+class _ProgressRelay(QObject):
+    # emitted from the worker thread, delivered to the label in the main thread
+    message = Signal(str)
+
+
+class TaskRunner:
+    """
+    Runs the long widget actions in napari worker threads so the viewer
+    stays responsive, showing their progress in ``label``.
+
+    Every button runs at most one job: clicking it again while its job runs
+    cancels the job, which stops at the next frame or block (see
+    ``tseg.core.parallel.task_context``).
+    """
+
+    def __init__(self, label):
+        self.label = label
+        self._relay = _ProgressRelay()
+        self._relay.message.connect(label.setText)
+        self._jobs = {}
+
+    def run(self, button, task, on_done=None):
+        """
+        Runs ``task()`` in a worker thread and ``on_done(result)`` back in the
+        main thread, where layers can be added. ``task`` must not touch Qt
+        widgets, read their values before starting it.
+        """
+        if button in self._jobs:
+            self.cancel(button)
+            return None
+
+        name = button.text()
+        cancelled = threading.Event()
+
+        def report(desc, done, total):
+            self._relay.message.emit(f"{name}: {desc or 'frames'} {done}/{total}")
+
+        def work():
+            with task_context(report, cancelled.is_set):
+                return task()
+
+        def finish(message):
+            del self._jobs[button]
+            button.setText(name)
+            self.label.setText(message)
+
+        def on_returned(result):
+            finish(f"{name}: done")
+            if on_done is not None:
+                on_done(result)
+
+        def on_error(exception):
+            if isinstance(exception, Cancelled):
+                finish(f"{name}: cancelled")
+                return
+            finish(f"{name}: error: {exception}")
+            traceback.print_exception(type(exception), exception, exception.__traceback__)
+
+        # errors are reported here instead of being re-raised in the main thread
+        worker = create_worker(work, _ignore_errors=True)
+        worker.returned.connect(on_returned)
+        worker.errored.connect(on_error)
+        self._jobs[button] = (name, cancelled)
+        button.setText(f"Cancel {name}")
+        self.label.setText(f"{name}: started...")
+        worker.start()
+        return worker
+
+    def cancel(self, button):
+        name, cancelled = self._jobs[button]
+        cancelled.set()
+        self.label.setText(f"{name}: cancelling...")
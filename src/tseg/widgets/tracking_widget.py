@@ -1,11 +1,27 @@
+import os
+import uuid
+from pathlib import Path
 from qtpy.QtWidgets import *
 from qtpy.QtCore import Qt
-from tseg.config import shared_config, TsegStyles  # Import shared_config
+from tseg.config import shared_config, session_temp_dir, TsegStyles  # Import shared_config
 import numpy as np  # Import numpy as np
+from scipy import sparse
 from napari.layers import Points
 import pandas as pd  # Import pandas for DataFrame manipulation
-from tseg.core.tracking import ccl_3d, noise_removal, center_detection, tracker, preprocessing_for_clustering, computing_affinity, clustering, visualize_clusters  # Import functions from tracking.py
+from tseg.core.tracking import (  # Import functions from tracking.py
+    ccl_3d,
+    noise_removal,
+    frame_statistics,
+    stream_centers,
+    tracker,
+    preprocessing_for_clustering,
+    computing_affinity,
+    sparse_affinity,
+    windowed_affinity,
+    SpectralEmbedding,
+)
 from tseg.widgets import QHLine
+from tseg.widgets.task_runner import TaskRunner
 
 
 class TrackingWidget(QWidget):
@@ -15,12 +31,29 @@ class TrackingWidget(QWidget):
         self.viewer = napari_viewer
         layout = QVBoxLayout(self)
 
-        def _populate_image_dropdown(dropdown):
+        self.output_dir = session_temp_dir()
+        self._cluster_cache = None
+
+        def _populate_image_dropdown(dropdown, layer_types=("image",)):
             dropdown.clear()
             dropdown.addItem("-select image-")
-            image_names = [layer.name for layer in self.viewer.layers if layer._type_string == "image"]
+            image_names = [layer.name for layer in self.viewer.layers if layer._type_string in layer_types]
             dropdown.addItems(image_names)
 
+        # Parallel execution settings shared by the per-frame stages
+        workersFormLayout = QFormLayout()
+        layout.addLayout(workersFormLayout)
+        self.workersSpinBox = QSpinBox()
+        self.workersSpinBox.setRange(1, os.cpu_count() or 1)
+        self.workersSpinBox.setValue(os.cpu_count() or 1)
+        self.workersSpinBox.setToolTip("Number of parallel workers used for labeling, noise removal and center detection")
+        workersFormLayout.addRow("Workers", self.workersSpinBox)
+
+        # every stage runs in the background, clicking its button again cancels it
+        self.statusLabel = QLabel("")
+        workersFormLayout.addRow(self.statusLabel)
+        self.tasks = TaskRunner(self.statusLabel)
+
         # Connected Component Section
         cclGroupBox = QGroupBox()
         cclGroupBox.setTitle("Connected Component Labeling")
@@ -65,6 +98,10 @@ class TrackingWidget(QWidget):
         self.volThresholdSpinBox.setValue(2)
         nrFormLayout.addRow("Volume Threshold", self.volThresholdSpinBox)
 
+        self.cleanedLabelsCheckBox = QCheckBox()
+        self.cleanedLabelsCheckBox.setToolTip("Also write a relabeled label volume without the removed components")
+        nrFormLayout.addRow("Add Cleaned Labels", self.cleanedLabelsCheckBox)
+
         self.noiseRemovalButton = QPushButton("Remove Noise")
         self.noiseRemovalButton.setStyleSheet(TsegStyles.BTN_PRIMARY)
         self.noiseRemovalButton.clicked.connect(self.remove_noise)
@@ -103,6 +140,35 @@ class TrackingWidget(QWidget):
         layout.addWidget(line)  # Add horizontal line
         layout.addSpacerItem(QSpacerItem(10, 10, QSizePolicy.Minimum, QSizePolicy.Expanding))
 
+        # Streaming Center Detection Section: labeling, noise removal and
+        # center detection in one pass over the frames
+        scdGroupBox = QGroupBox()
+        scdGroupBox.setTitle("Streaming Center Detection")
+        scdGroupBox.setStyleSheet("QGroupBox { font-size: 16pt; padding-top: 20px;}")
+        scdFormLayout = QFormLayout()
+        scdGroupBox.setLayout(scdFormLayout)
+        layout.addWidget(scdGroupBox)
+
+        self.scdImageDD = QComboBox(self)
+        _populate_image_dropdown(self.scdImageDD)
+        scdFormLayout.addRow("Original Data", self.scdImageDD)
+
+        self.scdVolThresholdSpinBox = QSpinBox()
+        self.scdVolThresholdSpinBox.setRange(1, 100)
+        self.scdVolThresholdSpinBox.setValue(2)
+        scdFormLayout.addRow("Volume Threshold", self.scdVolThresholdSpinBox)
+
+        self.streamCentersButton = QPushButton("Detect Centers")
+        self.streamCentersButton.setStyleSheet(TsegStyles.BTN_PRIMARY)
+        self.streamCentersButton.clicked.connect(self.stream_detect_centers)
+        scdFormLayout.addRow(self.streamCentersButton)
+
+        layout.addSpacerItem(QSpacerItem(10, 10, QSizePolicy.Minimum, QSizePolicy.Expanding))
+        line = QHLine()
+        line.setStyleSheet("color: white; background-color: white; height: 2px;")
+        layout.addWidget(line)  # Add horizontal line
+        layout.addSpacerItem(QSpacerItem(10, 10, QSizePolicy.Minimum, QSizePolicy.Expanding))
+
         # Track Section
         trackGroupBox = QGroupBox()
         trackGroupBox.setTitle("Tracking")
@@ -115,6 +181,13 @@ class TrackingWidget(QWidget):
         _populate_image_dropdown(self.trackCentersDD)
         trackFormLayout.addRow("Centers Data", self.trackCentersDD)
 
+        self.maxGapSpinBox = QSpinBox()
+        self.maxGapSpinBox.setRange(-1, 1000)
+        self.maxGapSpinBox.setSpecialValueText("Never")
+        self.maxGapSpinBox.setValue(-1)
+        self.maxGapSpinBox.setToolTip("Finish tracks that stay unmatched for more than this many frames")
+        trackFormLayout.addRow("Finish Tracks After Gap", self.maxGapSpinBox)
+
         self.trackButton = QPushButton("Track")
         self.trackButton.setStyleSheet(TsegStyles.BTN_PRIMARY)
         self.trackButton.clicked.connect(self.track)
@@ -148,18 +221,60 @@ class TrackingWidget(QWidget):
         self.clusterNumSpinBox.setValue(3)
         clusteringFormLayout.addRow("Number of Clusters", self.clusterNumSpinBox)
 
+        # Discretize is what clustering() (SpectralClustering) assigns, KMeans runs on the embedding
+        self.assignLabelsDD = QComboBox(self)
+        self.assignLabelsDD.addItems(["Discretize", "KMeans"])
+        clusteringFormLayout.addRow("Label Assignment", self.assignLabelsDD)
+
+        # 0 keeps the dense all-pairs affinity
+        self.neighborsSpinBox = QSpinBox()
+        self.neighborsSpinBox.setRange(0, 500)
+        self.neighborsSpinBox.setValue(0)
+        self.neighborsSpinBox.setSpecialValueText("Dense")
+        clusteringFormLayout.addRow("Nearest Neighbours", self.neighborsSpinBox)
+
+        # 0 only clusters tracks that span every frame, as one AR model each
+        self.windowSpinBox = QSpinBox()
+        self.windowSpinBox.setRange(0, 1000)
+        self.windowSpinBox.setValue(0)
+        self.windowSpinBox.setSpecialValueText("Full tracks")
+        clusteringFormLayout.addRow("AR Window (frames)", self.windowSpinBox)
+
+        self.stepSpinBox = QSpinBox()
+        self.stepSpinBox.setRange(1, 1000)
+        self.stepSpinBox.setValue(10)
+        clusteringFormLayout.addRow("Window Step (frames)", self.stepSpinBox)
+
+        # affinity checkpoints, labels and sparse affinities; unlike ~/.tseg this is kept
+        # between sessions, so an interrupted dense affinity resumes in the next one
+        self.clusterOutputEdit = QLineEdit(shared_config["output_dir"])
+        self.clusterOutputEdit.setToolTip("Directory for the affinity checkpoint, labels.npy and affinity.npz")
+        clusteringFormLayout.addRow("Clustering Output", self.clusterOutputEdit)
+
         self.clusterButton = QPushButton("Cluster Trajectories")
         self.clusterButton.setStyleSheet(TsegStyles.BTN_PRIMARY)
         self.clusterButton.clicked.connect(self.cluster_trajectories)
         clusteringFormLayout.addRow(self.clusterButton)
 
+        # eigengap and (sampled) silhouette for every number of clusters
+        self.clusterScoresLabel = QLabel("")
+        self.clusterScoresLabel.setWordWrap(True)
+        clusteringFormLayout.addRow(self.clusterScoresLabel)
+
         # Connect layer events to update dropdowns
-        dropdowns = [self.ccImageDD, self.nrImageDD, self.nrLabeledDD, self.cdImageDD, self.cdLabeledDD, self.trackCentersDD, self.clusterCentersDD]
+        dropdowns = [self.ccImageDD, self.nrImageDD, self.nrLabeledDD, self.cdImageDD, self.cdLabeledDD, self.scdImageDD]
+        # centers can come from an image or from a streaming points layer
+        centers_dropdowns = [self.trackCentersDD, self.clusterCentersDD]
+
+        for dropdown, layer_types in [(dd, ("image",)) for dd in dropdowns] + [(dd, ("image", "points")) for dd in centers_dropdowns]:
+            _populate_image_dropdown(dropdown, layer_types)
+            self.viewer.layers.events.inserted.connect(lambda event, dd=dropdown, lt=layer_types: _populate_image_dropdown(dd, lt))
+            self.viewer.layers.events.removed.connect(lambda event, dd=dropdown, lt=layer_types: _populate_image_dropdown(dd, lt))
+            self.viewer.layers.events.changed.connect(lambda event, dd=dropdown, lt=layer_types: _populate_image_dropdown(dd, lt))
 
-        for dropdown in dropdowns:
-            self.viewer.layers.events.inserted.connect(lambda event, dd=dropdown: _populate_image_dropdown(dd))
-            self.viewer.layers.events.removed.connect(lambda event, dd=dropdown: _populate_image_dropdown(dd))
-            self.viewer.layers.events.changed.connect(lambda event, dd=dropdown: _populate_image_dropdown(dd))
+    def _output_path(self, name, suffix):
+        # a fresh file per run, a layer of an earlier run may still be mapped onto its file
+        return self.output_dir / f"{name}_{suffix}_{uuid.uuid4().hex[:8]}.npy"
 
     def calculate_connected_component(self):
         selected_image = self.ccImageDD.currentText()
@@ -169,9 +284,18 @@ class TrackingWidget(QWidget):
 
         selected_layer = self.viewer.layers[selected_image]
         img_data = selected_layer.data
-        labeled, ncomponents = ccl_3d(img_data)
-        self.viewer.add_image(labeled.astype(np.uint8), name=f"{selected_layer.name}_labeled")
-        print(f"Number of components: {ncomponents}")
+        # Labels are written to a memory-mapped file so the labeled movie
+        # does not have to fit in RAM next to the original data.
+        output_path = self._output_path(selected_layer.name, "labeled")
+        workers = self.workersSpinBox.value()
+
+        def on_done(result):
+            labeled, ncomponents = result
+            labeled_layer = self.viewer.add_image(labeled, name=f"{selected_layer.name}_labeled")
+            labeled_layer.metadata["path"] = str(output_path)
+            print(f"Number of components: {ncomponents}")
+
+        self.tasks.run(self.ccButton, lambda: ccl_3d(img_data, out=output_path, workers=workers), on_done)
 
     def remove_noise(self):
         selected_image = self.nrImageDD.currentText()
@@ -183,8 +307,26 @@ class TrackingWidget(QWidget):
         img_data = self.viewer.layers[selected_image].data
         labeled = self.viewer.layers[selected_labeled].data
         vol_threshold = self.volThresholdSpinBox.value()
-        thr_idxs = noise_removal(img_data, labeled, vol_threshold)
-        self.viewer.layers[selected_labeled].metadata["thr_idxs"] = thr_idxs
+        workers = self.workersSpinBox.value()
+        labeled_layer = self.viewer.layers[selected_labeled]
+        if not self.cleanedLabelsCheckBox.isChecked():
+            def on_thresholds(thr_idxs):
+                labeled_layer.metadata["thr_idxs"] = thr_idxs
+
+            self.tasks.run(self.noiseRemovalButton, lambda: noise_removal(img_data, labeled, vol_threshold, workers=workers), on_thresholds)
+            return
+
+        output_path = self._output_path(selected_labeled, "cleaned")
+
+        def on_cleaned(result):
+            thr_idxs, cleaned = result
+            labeled_layer.metadata["thr_idxs"] = thr_idxs
+            cleaned_layer = self.viewer.add_image(cleaned, name=f"{selected_labeled}_cleaned")
+            cleaned_layer.metadata["path"] = str(output_path)
+            # the kept components are relabeled 1..n in the cleaned volume
+            cleaned_layer.metadata["thr_idxs"] = [np.arange(1, len(idxs) + 1) for idxs in thr_idxs]
+
+        self.tasks.run(self.noiseRemovalButton, lambda: noise_removal(img_data, labeled, vol_threshold, workers=workers, out=output_path), on_cleaned)
 
     def detect_centers(self):
         selected_image = self.cdImageDD.currentText()
@@ -196,16 +338,46 @@ class TrackingWidget(QWidget):
         img_data = self.viewer.layers[selected_image].data
         labeled = self.viewer.layers[selected_labeled].data
         thr_idxs = self.viewer.layers[selected_labeled].metadata.get("thr_idxs", [])
-        all_centers_noisefree = center_detection(img_data, labeled, thr_idxs)
+        workers = self.workersSpinBox.value()
 
-        centers_array = np.zeros_like(img_data, dtype=np.uint8)
-        for t, centers in enumerate(all_centers_noisefree):
-            for center in centers:
-                z, x, y = map(int, center)
-                centers_array[t, z, x, y] = 1
+        def task():
+            all_stats = frame_statistics(img_data, labeled, thr_idxs or None, workers=workers)
+            all_centers_noisefree = [stats.centroid for stats in all_stats]
 
-        centers_layer = self.viewer.add_image(centers_array, name=f"{selected_image}_centers")
-        centers_layer.metadata["all_centers_noisefree"] = all_centers_noisefree
+            centers_array = np.zeros_like(img_data, dtype=np.uint8)
+            for t, centers in enumerate(all_centers_noisefree):
+                for center in centers:
+                    z, x, y = map(int, center)
+                    centers_array[t, z, x, y] = 1
+            return centers_array, all_centers_noisefree, all_stats
+
+        def on_done(result):
+            centers_array, all_centers_noisefree, all_stats = result
+            centers_layer = self.viewer.add_image(centers_array, name=f"{selected_image}_centers")
+            centers_layer.metadata["all_centers_noisefree"] = all_centers_noisefree
+            centers_layer.metadata["object_statistics"] = all_stats
+
+        self.tasks.run(self.centerDetectionButton, task, on_done)
+
+    def stream_detect_centers(self):
+        selected_image = self.scdImageDD.currentText()
+        if selected_image == "-select image-":
+            print("No image selected!")
+            return
+
+        img_data = self.viewer.layers[selected_image].data
+        vol_threshold = self.scdVolThresholdSpinBox.value()
+
+        def on_done(result):
+            all_centers_noisefree, all_stats = result
+            # one (t, z, y, x) point per center instead of a dense centers image
+            points = [np.column_stack([np.full(len(centers), t), centers]) for t, centers in enumerate(all_centers_noisefree)]
+            points = np.concatenate(points) if points else np.zeros((0, 4))
+            centers_layer = self.viewer.add_points(points, name=f"{selected_image}_centers", size=2, face_color="yellow")
+            centers_layer.metadata["all_centers_noisefree"] = all_centers_noisefree
+            centers_layer.metadata["object_statistics"] = all_stats
+
+        self.tasks.run(self.streamCentersButton, lambda: stream_centers(img_data, vol_threshold), on_done)
 
     def track(self):
         selected_centers = self.trackCentersDD.currentText()
@@ -219,17 +391,16 @@ class TrackingWidget(QWidget):
             print("No center data found in metadata!")
             return
 
-        xx, yy, zz = tracker(all_centers_noisefree)
-        self.visualize_tracking(xx, yy, zz)
+        max_gap = self._max_gap()
+        self.tasks.run(self.trackButton, lambda: tracker(all_centers_noisefree, method="gated", max_gap=max_gap, as_table=True), self.visualize_tracking)
 
-    def visualize_tracking(self, xx, yy, zz):
-        points = []
-        for i in range(len(xx)):
-            for j in range(len(xx[i])):
-                points.append([zz[i][j], xx[i][j], yy[i][j]])
+    def _max_gap(self):
+        max_gap = self.maxGapSpinBox.value()
+        return None if max_gap < 0 else max_gap
 
-        points_layer = Points(points, name="Tracked Points", size=1, face_color="red", edge_color="white")
-        self.viewer.add_layer(points_layer)
+    def visualize_tracking(self, table):
+        tracks_layer = self.viewer.add_tracks(table.napari_tracks(), name="Tracks")
+        tracks_layer.metadata["track_table"] = table
 
     def cluster_trajectories(self):
         ar_order = self.arOrderSpinBox.value()
@@ -246,41 +417,86 @@ class TrackingWidget(QWidget):
             print("No center data found in metadata!")
             return
 
-        xx, yy, zz = tracker(all_centers_noisefree)
+        # the embedding only depends on these, changing the number of clusters reuses it
+        key = (selected_centers, id(all_centers_noisefree), ar_order, self.neighborsSpinBox.value(), self._max_gap(), self.windowSpinBox.value(), self.stepSpinBox.value())
+        cache = self._cluster_cache
+        assign_labels = self.assignLabelsDD.currentText().lower()
+        settings = dict(
+            max_gap=self._max_gap(),
+            window=self.windowSpinBox.value(),
+            step=self.stepSpinBox.value(),
+            n_neighbors=self.neighborsSpinBox.value(),
+            max_clusters=self.clusterNumSpinBox.maximum(),
+            workers=self.workersSpinBox.value(),
+            out_dir=Path(self.clusterOutputEdit.text()).expanduser() / f"{selected_centers}_affinity",
+        )
+
+        def task():
+            nonlocal cache
+            if cache is None or cache[0] != key:
+                trajectories, point_rows, embedding = self._spectral_embedding(all_centers_noisefree, ar_order, **settings)
+                cache = (key, trajectories, point_rows, embedding)
+            embedding = cache[3]
+            scores = embedding.sweep(range(1, min(settings["max_clusters"], embedding.max_clusters) + 1), assign_labels)
+            return cache, embedding.labels(min(cluster_num, embedding.max_clusters), assign_labels), scores
+
+        def on_done(result):
+            self._cluster_cache, labels, scores = result
+            self.clusterScoresLabel.setText("\n".join(f"k={k}: eigengap={eigengap:.4f}, silhouette={silhouette:.4f}" for k, (_, eigengap, silhouette) in scores.items()))
+            _, (xx, yy, zz), point_rows, embedding = self._cluster_cache
+            np.save(settings["out_dir"] / "labels.npy", labels)
+            if point_rows is not None:
+                # windowed mode clusters whole (partial) tracks, colour each of their points
+                labels = labels[point_rows]
+
+            # Visualize clusters in Napari
+            self.visualize_clusters_in_napari(xx, yy, zz, labels, cluster_num)
+
+            print(f"Clustering with AR order: {ar_order} and number of clusters: {cluster_num}")
+
+        self.tasks.run(self.clusterButton, task, on_done)
+
+    def _spectral_embedding(self, all_centers_noisefree, ar_order, max_gap, window, step, n_neighbors, max_clusters, workers, out_dir):
+        # runs in a worker thread, so every widget value is passed in
+        Path(out_dir).mkdir(parents=True, exist_ok=True)
+        table = tracker(all_centers_noisefree, method="gated", max_gap=max_gap, as_table=True)
+
+        if window:
+            # AR models of sliding windows, so partial tracks are clustered as well
+            sim1, track_index, flatten_AR_mat, C = windowed_affinity(table, window, step, ar_order, n_neighbors=n_neighbors, workers=workers)
+            row_of_track = np.full(len(table), -1)
+            row_of_track[track_index] = np.arange(len(track_index))
+            points = row_of_track[table.track_id] >= 0
+            trajectories = (table.y[points], table.x[points], table.z[points])
+            return trajectories, row_of_track[table.track_id[points]], SpectralEmbedding(sim1, max_clusters)
 
         # Pre Processing for clustering
-        tracked_frames = len(all_centers_noisefree) - 1
-        object_numbers = len(xx)
-        xx, yy, zz = preprocessing_for_clustering(xx, yy, zz, tracked_frames, object_numbers)
+        tracked_frames = len(all_centers_noisefree)
+        xx, yy, zz = preprocessing_for_clustering(table, frame_number=tracked_frames)
 
         # Setting Auto regressive parameters and other initializations
         number_of_points = np.shape(xx)[0]
         columns = ar_order * 2 * 2
         flatten_AR_mat = np.zeros(shape=(number_of_points, columns))
-        print((number_of_points, columns), flatten_AR_mat.shape)
 
         # Creating a pool of preprocessed trajectories
         traj_pool = np.stack([xx, yy, zz])
-        print(traj_pool.shape, len(xx))
 
         # Computing the affinity matrix for clustering
-        sim1, sim2, A_matrices, (X, C) = computing_affinity(traj_pool, tracked_frames, flatten_AR_mat, number_of_points, ar_order)
-
-        # Perform clustering
-        labels = clustering(sim1, cluster_num, "labels.npy", "affinity.npy")
-
-        # Visualize clusters in Napari
-        self.visualize_clusters_in_napari(xx, yy, zz, labels, cluster_num)
+        if n_neighbors:
+            sim1, flatten_AR_mat, (X, C) = sparse_affinity(traj_pool, tracked_frames, ar_order, n_neighbors=n_neighbors, workers=workers)
+            sparse.save_npz(Path(out_dir) / "affinity.npz", sim1)
+        else:
+            # checkpointed and memory-mapped, an interrupted (or cancelled) run resumes where it stopped
+            sim1, sim2, A_matrices, (X, C) = computing_affinity(traj_pool, tracked_frames, flatten_AR_mat, number_of_points, ar_order, workers=workers, out_dir=out_dir)
 
-        print(f"Clustering with AR order: {ar_order} and number of clusters: {cluster_num}")
+        # one eigen-decomposition for every number of clusters the widget offers
+        return (xx, yy, zz), None, SpectralEmbedding(sim1, max_clusters)
 
     def visualize_clusters_in_napari(self, xx, yy, zz, labels, cluster_num):
         colors = ["red", "green", "blue", "yellow", "cyan", "magenta", "white", "orange", "purple", "brown"]
         for cluster_id in range(cluster_num):
-            cluster_points = []
-            for i in range(len(xx)):
-                if labels[i] == cluster_id:
-                    for j in range(len(xx[i])):
-                        cluster_points.append([zz[i][j], xx[i][j], yy[i][j]])
+            in_cluster = np.asarray(labels) == cluster_id
+            cluster_points = np.stack([zz[in_cluster], xx[in_cluster], yy[in_cluster]], axis=-1).reshape(-1, 3)
             points_layer = Points(cluster_points, name=f"Cluster {cluster_id + 1}", size=2, face_color=colors[cluster_id % len(colors)], edge_color="white")
             self.viewer.add_layer(points_layer)